@@ -0,0 +1,162 @@
+"""
+Conformance checks and throughput measurements for the Tiger and Tiger Tree Hash implementations.
+Everything runs offline: the published test vectors are checked first, after which tiger.hash, pydc_client.tiger_hash and pydc_client.tth_generate are timed for a number of data sizes, once for each hashing backend (and once more across worker processes in case of tth_generate).
+Usage:
+	python benchmark.py [--sizes 64,1024,8192] [--repeat 3] [--output benchmark.json] [--baseline previous.json] [--tolerance 20]
+		--sizes : Comma separated data sizes in KB to be measured.
+		--repeat : Number of runs per measurement; the fastest one is reported.
+		--output : File to which the results are written, in JSON format.
+		--baseline : Results of an earlier run, against which the current ones are compared.
+		--tolerance : Percentage by which throughput may drop relative to the baseline before it is reported as a regression.
+	The exit status is 1 if a test vector fails or a regression is found, and 0 otherwise.
+"""
+
+import argparse, base64, json, os, platform, shutil, sys, tempfile, time
+import pydc_client, tiger
+
+# (input, digest) : Digests are in the standard byte order, as returned by Tiger.digest().
+TIGER_VECTORS = [
+	("", "3293AC630C13F0245F92BBB1766E16167A4E58492DDE73F3"),
+	("abc", "2AAB1484E8C158F2BFB8C5FF41B57A525129131C957B5F93"),
+	("Tiger", "DD00230799F5009FEC6DEBC838BB6A27DF2B9D6F110C7937"),
+	("The quick brown fox jumps over the lazy dog", "6D12A41E72E644F017B6F0E2F7B44C6285F06DD5D2C5B075"),
+	("abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq", "0F7BF9A19B9C58F2B7610DF7E84F0AC3A71C631E7B53F78E"),
+	("a"*1000000, "6DB0E2729CBEAD93D715C6A7D36302E9B3CEE0D2BC314B41"),
+]
+
+# (name, file contents, root) : The 1024/1025 byte files sit on either side of the first leaf boundary.
+TTH_VECTORS = [
+	("empty file", "", "LWPNACQDBZRYXW3VHJVCJ64QBZNGHOHHHZWCLNQ"),
+	("single zero byte", chr(0), "VK54ZIEEVTWNAUI5D5RDFIL37LX2IQNSTAXFKSA"),
+	("1024 x 'A'", "A"*1024, "L66Q4YVNAFWVS23X2HJIRA5ZJ7WXR3F26RSASFA"),
+	("1025 x 'A'", "A"*1025, "PZMRYHGY6LTBEH63ZWAHDORHSYTLO4LEFUIKHWY"),
+]
+
+def backends(): # Hashing backends available on this system, as (name, numpy module or None) pairs.
+	result = [("scalar", None)]
+	if tiger.numpy is not None: result.append(("numpy", tiger.numpy))
+	return result
+
+def use_backend(module): # Selects the backend used by tiger.hash_lanes.
+	tiger.numpy = module
+
+def check_vectors(client, directory): # Returns a list of results, one for every test vector and backend.
+	result = []
+	for name, module in backends():
+		use_backend(module)
+		for data, expected in TIGER_VECTORS:
+			actual = base64.b16encode(client.tiger_hash(data))
+			result.append({"type":"tiger", "backend":name, "name":repr(data[:16])+("..." if len(data)>16 else "")+" (%d bytes)" % len(data), "expected":expected, "actual":actual, "passed":actual==expected})
+			if len(data)>4096: continue # Long messages are covered by the TTH throughput runs
+			actual = base64.b16encode(tiger.hash_many([data]*tiger.LANES_MIN)[-1])
+			result.append({"type":"tiger-lanes", "backend":name, "name":repr(data[:16])+("..." if len(data)>16 else "")+" (%d bytes)" % len(data), "expected":expected, "actual":actual, "passed":actual==expected})
+		for label, data, expected in TTH_VECTORS:
+			filename = os.path.join(directory, "vector.dat")
+			handle = open(filename, "wb"); handle.write(data); handle.close()
+			actual = client.tth_generate(filename)
+			result.append({"type":"tth", "backend":name, "name":label, "expected":expected, "actual":actual, "passed":actual==expected})
+	use_backend(backends()[-1][1])
+	return result
+
+def measure(function, size, repeat): # Returns the best time taken by function over the given number of runs.
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		function()
+		taken = time.time()-start
+		if best is None or taken<best: best = taken
+	return best
+
+def throughput(client, directory, sizes, repeat): # Returns a list of measurements, one for every function, backend and size.
+	result = []
+	for size in sizes:
+		data = os.urandom(size*1024)
+		filename = os.path.join(directory, "throughput.dat")
+		handle = open(filename, "wb"); handle.write(data); handle.close()
+		functions = [
+			("tiger.hash", lambda: tiger.hash(data)),
+			("pydc_client.tiger_hash", lambda: client.tiger_hash(data)),
+			("pydc_client.tth_generate", lambda: client.tth_generate(filename)),
+		]
+		for name, module in backends():
+			use_backend(module)
+			for function, call in functions:
+				if name!="scalar" and function!="pydc_client.tth_generate": continue # Only the TTH leaf level uses the batched engine
+				seconds = measure(call, size, repeat)
+				mbps = (size/1024.0)/seconds if seconds>0 else 0.0
+				result.append({"function":function, "backend":name, "size":size*1024, "seconds":seconds, "mbps":mbps})
+				print "%-26s %-8s %10d KB %10.3f s %10.3f MB/s" % (function, name, size, seconds, mbps)
+		use_backend(backends()[-1][1])
+		threshold = client._config["hash_parallel"]
+		client._config["hash_parallel"] = 0 # Hash even small files across worker processes
+		try: seconds = measure(functions[-1][1], size, repeat)
+		finally: client._config["hash_parallel"] = threshold
+		mbps = (size/1024.0)/seconds if seconds>0 else 0.0
+		result.append({"function":functions[-1][0], "backend":"parallel", "size":size*1024, "seconds":seconds, "mbps":mbps})
+		print "%-26s %-8s %10d KB %10.3f s %10.3f MB/s" % (functions[-1][0], "parallel", size, seconds, mbps)
+	return result
+
+def compare(current, baseline, tolerance): # Returns a list of measurements that have slowed down by more than tolerance percent.
+	previous = dict([((item["function"], item["backend"], item["size"]), item["mbps"]) for item in baseline["throughput"]])
+	result = []
+	for item in current:
+		key = (item["function"], item["backend"], item["size"])
+		if key not in previous or previous[key]<=0: continue
+		change = 100.0*(item["mbps"]-previous[key])/previous[key]
+		print "%-26s %-8s %10d KB %+9.1f %%" % (item["function"], item["backend"], item["size"]/1024, change)
+		if change<-tolerance: result.append(dict(item, baseline=previous[key], change=change))
+	return result
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Tiger/TTH conformance and throughput benchmark.")
+	parser.add_argument("--sizes", default="64,1024,8192", help="comma separated data sizes in KB")
+	parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+	parser.add_argument("--output", default="benchmark.json", help="file to which results are written")
+	parser.add_argument("--baseline", default=None, help="results of an earlier run to compare against")
+	parser.add_argument("--tolerance", type=float, default=20.0, help="allowed drop in throughput, in percent")
+	options = parser.parse_args(argv)
+	sizes = [int(x) for x in options.sizes.split(",") if x.strip()]
+	output = os.path.abspath(options.output)
+	baseline = json.load(open(options.baseline)) if options.baseline is not None else None
+
+	workdir = tempfile.mkdtemp(prefix="pydc-benchmark-")
+	cwd = os.getcwd()
+	os.chdir(workdir) # The client creates its data directories in the current directory
+	try:
+		client = pydc_client.pydc_client()
+		print "Checking test vectors ..."
+		vectors = check_vectors(client, workdir)
+		for item in vectors:
+			if not item["passed"]: print "FAILED : %s %s %s : expected %s, got %s" % (item["type"], item["backend"], item["name"], item["expected"], item["actual"])
+		passed = all([item["passed"] for item in vectors])
+		print "%d/%d test vectors passed." % (len([item for item in vectors if item["passed"]]), len(vectors))
+		print "Measuring throughput ..."
+		measurements = throughput(client, workdir, sizes, options.repeat)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(workdir, True)
+
+	regressions = []
+	if baseline is not None:
+		print "Comparing with %s ..." % options.baseline
+		regressions = compare(measurements, baseline, options.tolerance)
+		for item in regressions: print "REGRESSION : %s %s %d KB : %.3f MB/s, was %.3f MB/s" % (item["function"], item["backend"], item["size"]/1024, item["mbps"], item["baseline"])
+	result = {
+		"version":1,
+		"timestamp":time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+		"python":platform.python_version(),
+		"platform":platform.platform(),
+		"numpy":(tiger.numpy.__version__ if tiger.numpy is not None else None),
+		"vectors":vectors,
+		"throughput":measurements,
+		"regressions":regressions,
+		"passed":passed and len(regressions)==0,
+	}
+	handle = open(output, "w")
+	json.dump(result, handle, indent=1, sort_keys=True)
+	handle.close()
+	print "Results written to "+output
+	return 0 if result["passed"] else 1
+
+if __name__=="__main__":
+	sys.exit(main(sys.argv[1:]))
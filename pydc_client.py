@@ -1,5 +1,5 @@
 from connection import Connection, ConnectionError
-import base64, bz2, copy, ctypes, itertools, math, os, platform, random, re, socket, sys, time, tiger, threading, traceback, xml.dom.minidom
+import base64, bz2, collections, copy, ctypes, itertools, math, mmap, multiprocessing, os, platform, random, re, shutil, share, socket, sys, time, tiger, tigertree, threading, traceback
 
 # sys.stderr = open("error.txt","w")
 # Nicknames cannot contain spaces
@@ -38,9 +38,15 @@ class pydc_client():
 			group_find(<nickname>) : Returns which group the specified nickname belongs to.
 		The following functions are used to manage filelists, in addition to those mentioned above. Note that the <group> argument is optional, and may be omitted to use the default (general) group.
 			filelist_get(<nick>): Download the filelist of the specified user.
+			download_partial(<nick>,<path>,<recursive>): Download only the contents of a directory from the filelist of the specified user (with the directories within it, if recursive is True).
 			filelist_add(<dir/file-path>,<group>): Add the specified directory or file to the filelist of the specific group.
 			filelist_remove(<dir/file-path>,<group>): Remove the specified directory or file from the filelist of the specific group.
 			filelist_refresh(): Refresh the filelists for all groups.
+		The filelists of all groups are views of a single share, so a directory shared with several groups is scanned, stored and searched only once.
+		New files are hashed in the background, and appear in the filelists as soon as they are done. The following functions control this:
+			hash_pause() : Stops reading files until hash_resume() is called.
+			hash_resume() : Continues hashing after hash_pause().
+			hash_progress() : Returns a dictionary with the number of files hashed ("files"), bytes read ("bytes"), files and bytes still queued ("queue","queued_bytes"), the average read rate in bytes/second ("rate") and whether hashing is paused ("paused").
 		Finally, there exist some miscellaneous functions that might prove useful:
 			debug(<msg>): All functions send status, debug or error messages to a debug stream (which may or may not exist), via this function.
 			cli(): A function that provides a command line interface (CLI) for the client, for situations when a GUI extension is not available.
@@ -59,10 +65,21 @@ class pydc_client():
 		match = re.findall("\&\#([0-9]{1,3})\;",data.replace("&amp;","&#38;"));
 		for item in match: data = data.replace("&#"+item+";",chr(int(item)));
 		return data
-	def escape_filename(self,name):
+	def escape_adc(self,data): # Escapes the spaces and backslashes in an identifier sent in an $ADCGET/$ADCSND command (eg: the path of a partial filelist)
+		return data.replace("\\","\\\\").replace(" ","\\ ").replace("\n","\\n")
+	def split_adc(self,data): # Splits an $ADCGET/$ADCSND command into its parameters, unescaping them
+		result = [""]; escaped = False
+		for char in data:
+			if escaped: result[-1] += {"s":" ","n":"\n"}.get(char,char); escaped = False
+			elif char=="\\": escaped = True
+			elif char==" ":
+				if result[-1]!="": result.append("")
+			else: result[-1] += char
+		return [item for item in result if item!=""]
+	def escape_filename(self,name,type=False): # Converts characters that cannot appear in filenames into the form &<ascii>; (all non-alphanumeric characters, if type is True)
 		newname = ""
 		for i in name:
-			if i in "\/:*?\"<>|": newname+="&"+ord(i)+";"
+			if i in "\/:*?\"<>|" or (type and not i.isalnum()): newname+="&"+str(ord(i))+";"
 			else: newname+=i
 		return newname
 	def filesize(self,x): # Takes a int/long number of bytes and translates them into human readable form in terms of KB, MB, GB, etc
@@ -114,6 +131,9 @@ class pydc_client():
 	def __init__(self): # Initializes to default values all configuration variables and other objects required for the functioning of this system.
 		self._step = {} # Container for step thread and function
 		self._download = {} # Container for download manager thread and status variables
+		self._hasher = {} # Container for background hashing thread and status variables
+		self._responder = {} # Container for the threads answering searches from other users, and their status variables
+		self._listener = {} # Container for the UDP server receiving the results of active mode searches, the timer expiring searches, and the UDP socket sending results to other users
 		self._config = {} # This dictionary will store all the configuration variables that will subsequently be used by this client.
 		self._dir = {} # Application Directory Locations
 		# User Details
@@ -135,6 +155,22 @@ class pydc_client():
 		self._config["filelist"] = "files.xml.bz2" # The identifier of filelists in _queue
 		self._config["savedata"] = "configuration.dat" # The same of the file in which data will be saved
 		self._config["sr_count"] = 10 # Maximum number of search results to return per request
+		self._config["hash_lanes"] = 4096 # Number of 1 KB leaves hashed together while generating a TTH
+		self._config["hash_buffer"] = 1024*1024*4 # 4MB : Size of the chunks in which files are read while generating a TTH
+		self._config["hash_processes"] = 0 # Number of worker processes used to hash large files; 0 = one per CPU, 1 = hash serially
+		self._config["hash_parallel"] = 1024*1024*256 # 256MB : Files at least this large are hashed by multiple processes
+		self._config["list_depth"] = 1 # Number of directory levels in the partial filelists served, unless the whole directory is requested (RE1)
+		self._config["tthl_depth"] = 10 # The stored tree level has at most 2**tthl_depth nodes (leaves, for files smaller than 1MB)
+		self._config["tthl_store"] = "tthl.dat" # The name of the file in which tree levels are stored
+		self._config["hash_cache"] = "hashes.dat" # The name of the file in which the roots of hashed files are cached
+		self._config["share_snapshot"] = "share.dat" # The name of the file in which the share of all groups is saved (see share.ShareTree.save), so that it is available as soon as the client starts
+		self._config["hash_rate"] = 0 # Maximum rate (in MB/s) at which files are read by the background hasher, to leave disk bandwidth for transfers; 0 = unlimited
+		self._config["hash_chunk"] = 1024*1024*256 # 256MB : Amount of data the background hasher takes from its queue at a time, when hash_rate is unlimited
+		self._config["hash_publish"] = 60 # Number of seconds between rewriting filelists while the background hasher is running
+		self._config["bz2_block"] = 900*1000 # 900KB : Amount of data compressed at a time; in parallel mode, the size of every independent stream (the largest bz2 block size)
+		self._config["bz2_parallel"] = 1024*1024*8 # 8MB : Files (and filelists) at least this large are compressed in blocks by worker processes, as a multi-stream bz2 file
+		self._config["bz2_processes"] = 0 # Number of worker processes used to compress large files; 0 = one per CPU, 1 = compress serially
+		self._config["refresh_time"] = 300 # Number of seconds between refreshes of all filelists while connected; 0 = never
 		# Hub Details
 		self._config["host"] = "localhost" # The address of the hub to which we want to connect
 		self._config["port"] = 411 # The port at which the intended hub is running
@@ -143,13 +179,16 @@ class pydc_client():
 		# Connection Details
 		self._config["searchtime_manual"] = 15 # The time in seconds for which a user-initiated search is waiting for more results
 		self._config["searchtime_auto"] = 5 # The time in seconds for which an automatic search for TTH alternates is waiting for results
+		self._config["search_port"] = 0 # The UDP port at which the results of all active mode searches are received; 0 = a random port, chosen when the first search is made
+		self._config["sr_pack"] = False # Whether several search results are sent to active mode users in a single UDP datagram; many clients expect only one $SR per datagram, and ignore the rest
+		self._config["udp_mtu"] = 1472 # Maximum size of the UDP datagrams in which search results are packed, if sr_pack is set (an Ethernet MTU of 1500 bytes, less the IP and UDP headers)
 		self._config["retry"] = 3 # Number of times a connection request will be sent to a remote host if it isnt responding
 		self._config["wait"] = 5 # Number of seconds to wait between sending repeated connection requests.
 		# Negotionation Details
 		self._config["lock"] = "Majestic12" # A random string used during authentication
 		self._config["key"] = self.lock2key(self._config["lock"]) # Generated using the above lock used during authorization
 		self._config["signature"] = "SourceCode" # A random string used during negotiation, conventionally used to indicate client name
-		self._config["support"] = "XmlBZList ADCGet TTHF" # The set of protocols that this client supports (space separated). More options: MiniSlots, TTHL, ZLIG
+		self._config["support"] = "XmlBZList ADCGet TTHF TTHL" # The set of protocols that this client supports (space separated). More options: MiniSlots, ZLIG
 		# Transfer Control
 		self._download["upslots"] = 0 # The number of upload slots currently in use
 		self._download["maxupslots"] = 2 # The maximum number of upload slots possible
@@ -161,6 +200,7 @@ class pydc_client():
 		self._step["thread"] = None # The thread pointing to the step function
 		self._step["function"] = None # The function to be called at every step run
 		self._step["args"] = None # Arguments that are provided to and returned by every call of the ste function.
+		self._step["refresh"] = time.time() # When the filelists were last refreshed
 		# Download Manager
 		self._config["segment_size"] = 1024*1024*10 # 100MB : Size of blocks to be downloaded from different users
 		self._config["download_time"] = 1 # How long the step functions waits before each run
@@ -168,6 +208,46 @@ class pydc_client():
 		self._download["thread"] = None # The thread pointing to the download manager function
 		self._download["lock"] = threading.Semaphore() # A lock used to ensure that only one download is being inititated at a time.
 		self._config["overwrite"] = False # Whether or not to overwrite existing files with the same name after download.
+		self._config["verify_segments"] = True # Whether or not each part is checked against the tree of the file as it is downloaded
+		self._config["tthl_timeout"] = 60 # Number of seconds to wait for the tree of a file before downloading it without one
+		# Background Hashing
+		self._hasher["active"] = False # Whether the hasher is running
+		self._hasher["thread"] = None # The thread pointing to the hasher function
+		self._hasher["running"] = threading.Event() # Cleared while hashing is paused
+		self._hasher["running"].set()
+		self._hasher["lock"] = threading.Lock() # A lock used to ensure that the queue and counters are updated by one thread at a time
+		self._hasher["queue"] = collections.deque() # Files waiting to be hashed, as (share.ShareTree, directory entry, share.Record) entries
+		self._hasher["queued"] = set() # The paths in the queue, so that files are not queued twice
+		self._hasher["queued_bytes"] = 0 # Total size of the files in the queue
+		self._hasher["chunk"] = [] # Entries taken from the queue that are being hashed
+		self._hasher["files"] = 0 # Number of files hashed so far
+		self._hasher["bytes"] = 0 # Number of bytes read so far
+		self._hasher["start"] = time.time() # Start of the current throttling period
+		self._hasher["budget"] = 0 # Number of bytes read in the current throttling period
+		# Search Responders
+		self._config["search_workers"] = 2 # Number of threads answering searches from other users, so that the hub connection is never held up by them
+		self._config["search_queue"] = 50 # Maximum number of searches waiting to be answered; the oldest one is dropped to make room for a new one
+		self._config["search_rate"] = 5 # Maximum number of searches accepted per second from every source (IP address, or nick in passive mode); 0 = unlimited
+		self._responder["active"] = False # Whether the responders are running
+		self._responder["threads"] = [] # The threads pointing to the responder function
+		self._responder["lock"] = threading.Condition() # Used to ensure that the queue and counters are updated by one thread at a time, and to wake up responders when searches arrive
+		self._responder["queue"] = collections.deque() # $Search requests waiting to be answered, oldest first
+		self._responder["window"] = time.time() # Start of the current one second rate limiting period
+		self._responder["sources"] = {} # A dict containing source->number of searches accepted in the current period entries
+		self._responder["answered"] = 0 # Number of searches answered so far
+		self._responder["dropped"] = 0 # Number of searches dropped as the queue was full
+		self._responder["limited"] = 0 # Number of searches ignored as their source exceeded search_rate
+		self._config["search_cache"] = 500 # Maximum number of recent search results remembered, so that repeated searches are answered without searching the share; 0 = none
+		self._responder["cache"] = collections.OrderedDict() # A dict containing (group, isSizeRestricted, isMaxSize, size, fileType, normalized search term)->results entries, least recently used first
+		self._responder["version"] = None # The version of the share the cached results were taken from
+		self._responder["hits"] = 0 # Number of searches answered from the cache
+		self._responder["misses"] = 0 # Number of searches for which the share had to be searched
+		# Search Listener
+		self._listener["socket"] = None # A connection type object that sets up a UDP server on which to recieve search results, shared by all searches
+		self._listener["port"] = None # The port at which it is listening
+		self._listener["timer"] = None # A timer that removes searches once they have expired, set for the search that expires first
+		self._listener["sender"] = None # An unconnected UDP socket through which the results of all searches from active mode users are sent, created when it is first needed
+		self._listener["lock"] = threading.RLock() # A lock used to ensure that searches and the listener are updated by one thread at a time
 		# Default Streams/Connections
 		self._mainchat = sys.stdout # The function to which mainchat messages are sent
 		self._pm = None # The function to which mainchat messages are sent
@@ -179,10 +259,13 @@ class pydc_client():
 		self._groups = { self._config["group_base"]:[] } # A dict of lists, key = groupname, list values = members
 		self._filelist = { self._config["group_base"]:[] } # A dict containing group->list_of_dirs_to_be_shared entries. Entries here need to be shared yet.
 		# Temporary Data Structures
+		self._sharelock = threading.RLock() # A lock used to ensure that the shared filelists are modified and written by one thread at a time
 		self._nicklist = {} # A list of all nicknames connected to this hub
-		self._search = {} # A dict containing pointers to search pseudo-objects of the format: socket (a connection type object that sets up a UDP server on which to recieve search results), result (the stream to which results are sent upon arrival), mode (manual or auto)
+		self._search = {} # A dict containing pointers to search pseudo-objects of the format: result (the stream to which results are sent upon arrival), mode (manual or auto), expires (the time after which results are no longer accepted)
 		self._transfer = [] # A list containing pointers to transfer pseudo-objects of the format: {host,port,mode(active/passive),connection}
-		self._shared = { self._config["group_base"]: xml.dom.minidom.Document() } # A xml.dom object containing the files and folders currently shared.
+		self._share = share.ShareTree() # The files and folders currently shared with all groups; the filelist of each group is a view of it
+		self._groupbits = {} # A dict containing group->bit entries, identifying groups in the visibility masks of self._share
+		self._snapshot = {} # A dict containing source->{directory path: (modification time, entry)} entries, recording the state of every shared directory when it was last scanned
 		# Constant Data Structures
 		self._filetype = {"any":1,"audio":2,"compressed":3,"document":4,"executable":5,"image":6,"video":7,"folder":8,"tth":9} # Mapping of filetypes for search requests.
 		self._fileextn = {2:"mp mp wav au rm mid sm", 3:"zip arj rar lzh gz z arc pak", 4:"doc txt wri pdf ps tex", 5:"pm exe bat com", 6:"gif jpg jpeg bmp pcx png wmf psd", 7:"mpg mpeg avi asf mov"} # Allowed extension for specific filetypes in search requests.
@@ -192,11 +275,15 @@ class pydc_client():
 		self._dir["incomplete"] = "Incomplete"
 		self._dir["downloads"] = "Downloads"
 		self._dir["settings"] = "Settings"
+		self._dir["quarantine"] = "Quarantine" # Downloads that did not match their TTH
 		# Ensure that all necessary directories exists
 		if not os.path.isdir(self._dir["filelist"]): os.mkdir(self._dir["filelist"])
 		if not os.path.isdir(self._dir["incomplete"]): os.mkdir(self._dir["incomplete"])
 		if not os.path.isdir(self._dir["downloads"]): os.mkdir(self._dir["downloads"])
 		if not os.path.isdir(self._dir["settings"]): os.mkdir(self._dir["settings"])
+		if not os.path.isdir(self._dir["quarantine"]): os.mkdir(self._dir["quarantine"])
+		self._trees = tigertree.TreeStore(self._dir["settings"]+os.sep+self._config["tthl_store"]) # Tree levels of shared files, used to answer TTHL requests
+		self._hashes = tigertree.HashCache(self._dir["settings"]+os.sep+self._config["hash_cache"]) # Roots of files hashed earlier, so that unchanged files are not hashed again after a restart
 		# SHERIFFBOT : Additional variable to prevent userlist update during deepcopy
 		self._nicklock = threading.Semaphore()
 		self._config["ready"] = False
@@ -239,15 +326,21 @@ class pydc_client():
 			self.debug("Loading data ...")
 			f = open(self._dir["settings"]+os.sep+self._config["savedata"],"r")
 			data = eval(f.read())
-			for key in data: exec key+" = "+str(data[key])
+			for key in data:
+				if type(eval(key)) is dict: eval(key).update(data[key]) # Merge, so that defaults of options added since the data was saved are retained
+				else: exec key+" = "+str(data[key])
 			f.close()
 			self.debug("Data loaded successfully.")
 			self.debug("Loading Filelist(s) ...")
-			for group in self._groups:
-				x = self._dir["filelist"]+os.sep+"#"+self.escape_filename(group,True)+".xml"
-				if os.path.isfile(x): self._shared[group] = xml.dom.minidom.parse(x) # If the filelist for that group exists, load it
-				self.filelist_generate(group) # Update/Generate it if required.
-			self.debug("Filelist(s) loaded successfully.")
+			restored = share.restore(self._dir["settings"]+os.sep+self._config["share_snapshot"],self.filelist_key())
+			if restored is None: # Missing, damaged, or saved for other shared directories : The filelists written earlier are served until it has been rebuilt in the background.
+				self.debug("Share snapshot missing or out of date, regenerating filelist(s) in the background ...")
+				self.spawn("Filelist Generator",self.filelist_generate,(self._filelist.keys(),))
+			else:
+				self._share,(self._groupbits,self._snapshot,queue) = restored
+				self.hash_enqueue([(self._share,parent,share.Record(*record)) for parent,record in queue]) # Files that were still waiting to be hashed
+				self.spawn("Filelist Refresh",self.filelist_refresh) # Changes made while the client was not running are picked up in the background
+				self.debug("Filelist(s) loaded successfully.")
 		return self
 	def reset(self): # Deletes all previously saved configuration settings
 		for var in self._save: os.remove(self._dir["settings"]+os.sep+var[5:])
@@ -285,6 +378,7 @@ class pydc_client():
 		self._step["thread"] = self.spawn("Step Function",self.step_actual)
 		self._download["active"] = True
 		self._download["thread"] = self.spawn("Download Manager",self.download_manager)
+		self.hash_start() # Resume hashing files queued before an earlier disconnect
 		return self
 	def step_actual(self): # The actual function that waits for a fixed time between cycles and calls step_function.
 		while self._step["active"]:
@@ -292,14 +386,16 @@ class pydc_client():
 			if self._step["function"] is not None:
 				try: self._step["args"] = self._step["function"](self._step["args"])
 				except: pass
+			if self._config["refresh_time"]>0 and time.time()-self._step["refresh"]>=self._config["refresh_time"]: # Pick up changes to shared directories
+				self._step["refresh"] = time.time()
+				try: self.filelist_refresh()
+				except Exception as e: self.debug("Filelist Refresh Error : "+str(e))
 			time.sleep(self._config["step_time"])
 		return self
 	def disconnect(self): # Terminate all child threads of this object before disconnecting from the hub.
 		self._debug = lambda s: sys.stdout.write(s+"\n") # NOTICE : Debugging purposes
 		self.debug("Terminating all searches ...")
-		for item in self._search: # Terminate all searches
-			if self._search[item]["socket"] is not None and self._search[item]["socket"].active():
-				self._search[item]["socket"].close()
+		self.search_listener_stop()
 		self.debug("Terminating all transfers ...")
 		for transfer in self._transfer: # Terminate all transfers spawned
 			if transfer["socket"].active():
@@ -308,6 +404,10 @@ class pydc_client():
 		self._download["active"] = False
 		if self._download["thread"] is not None:
 			self._download["thread"].join()
+		self.debug("Terminating hashing thread ...")
+		self.hash_stop()
+		self.debug("Terminating search responder threads ...")
+		self.search_responder_stop()
 		self.debug("Terminating step thread ...")
 		self._step["active"] = False
 		if self._step["thread"] is not None:
@@ -410,7 +510,7 @@ class pydc_client():
 						continue
 					self._config["host"],self._config["port"] = addr
 					self.reconnect()
-				elif x[0]=="$Search": self.search_result_generate(data)
+				elif x[0]=="$Search": self.search_responder_enqueue(data) # Answered by the responder threads
 				elif x[0]=="$SR": self.search_result_process(data)
 				elif x[0]=="$ConnectToMe":
 					continue # SHERIFFBOT
@@ -433,7 +533,7 @@ class pydc_client():
 	def pm_send(self,nick,data): # Sends a private message to the specified user
 		self._socket.send("$To: %s From: %s $<%s> %s|" %(nick,self._config["nick"],self._config["nick"],self.escape(data)))
 		return self
-	def download_tth(self,tth,name=None,location=None,success_callback=None,success_callback_args=None,failure_callback=None,failure_callback_args=None): # INCOMPLETE : Validate TTH
+	def download_tth(self,tth,name=None,location=None,success_callback=None,success_callback_args=None,failure_callback=None,failure_callback_args=None): # Downloads the file with the given TTH, verifying each part against its tree and the whole file against the TTH
 		self._queue.append({"id":tth,"incomplete":tth,"parts":-1,"type":"tth","nick":[],"priority":3,"name":name,"location":location,"active":False,"considered":False,"success_callback":success_callback,"success_callback_args":success_callback_args,"failure_callback":failure_callback,"failure_callback_args":failure_callback_args})
 		return self
 	def download_filelist(self,nick,success_callback=None,success_callback_args=None,failure_callback=None,failure_callback_args=None): # Downloads the filelist of a specific user
@@ -443,6 +543,12 @@ class pydc_client():
 		if flag:
 			self._queue.append({"id":self._config["filelist"],"incomplete":self.escape_filename(nick)+".filelist","part":0,"parts":1,"type":"file","nick":[nick],"offset":"0","length":-1,"priority":5,"name":"@"+self.escape_filename(nick)+".xml.bz2","size":-1,"location":self._dir["filelist"], "active":False,"considered":False,"success_callback":success_callback,"success_callback_args":success_callback_args,"failure_callback":failure_callback,"failure_callback_args":failure_callback_args})
 		return self
+	def download_partial(self,nick,path,recursive=False,success_callback=None,success_callback_args=None,failure_callback=None,failure_callback_args=None): # Downloads part of the filelist of a specific user : a directory (given as a path from the top of the filelist, separated by slashes), with the directories within it if recursive is True, or just one level otherwise. The list is saved uncompressed.
+		path = "/"+"/".join([name for name in path.split("/") if name!=""])+("/" if path.strip("/")!="" else "")
+		for item in self._queue:
+			if item["type"]=="list" and item["id"]==path and item["nick"]==[nick] and item["recursive"]==recursive: return self # Already queued
+		self._queue.append({"id":path,"incomplete":self.escape_filename(nick+path)+".list","part":0,"parts":1,"type":"list","recursive":recursive,"nick":[nick],"offset":"0","length":-1,"priority":5,"name":"@"+self.escape_filename(nick+path)+".xml","size":-1,"location":self._dir["filelist"], "active":False,"considered":False,"success_callback":success_callback,"success_callback_args":success_callback_args,"failure_callback":failure_callback,"failure_callback_args":failure_callback_args})
+		return self
 	def download_manager(self): # An infinite loop that keeps trying to start queued downloads.
 		while self._download["active"]: # Keep doing this as long as the client runs
 			flag = False; # Initially assume that new search will be performed, so wait for a while before the next cycle
@@ -452,11 +558,11 @@ class pydc_client():
 				# print "Download Queue :", [i["name"]+":"+str(i["part"]) if "part" in i else "-1" for i in self._queue] # NOTICE : DEBUG only
 				if self._download["downslots"]==self._download["maxdownslots"]: break # If slots are not available, wait for a while
 				if item["active"]==True or item["considered"]==True: continue # If item isnt already being downloaded
-				if item["type"]=="file": # Filelist Downloads
+				if item["type"] in ("file","tthl","list"): # Filelist, Tree and Partial Filelist Downloads
 					item["considered"] = True
 					def fail():
 						item["considered"] = False
-						self.debug("Removing filelist from queue as "+str(item["nick"])+" is not responding.")
+						self.debug("Removing "+{"file":"filelist","tthl":"tree","list":"partial filelist"}[item["type"]]+" from queue as "+str(item["nick"])+" is not responding.")
 						self._queue.remove(item) # SHERIFFBOT : Delete this item from queue
 						if item["failure_callback"]!=None:
 							try:
@@ -469,24 +575,34 @@ class pydc_client():
 					self.connect_remote(item["nick"],True,fail) # Connect to the peer. Filelists always have only one part, an assumption made in filelist_get.
 				elif item["type"]=="tth": # TTH Downloads
 					if item["parts"]==-1: # What to do if no other information about the file is available
-						flag = True # No need to wait after one cycle
-						result = [] # List to hold search results from sources
-						self.search("TTH:"+item["id"],lambda x:result.append(x),{"type":"tth","mode":"auto"}) # Start a search for sources
-						time.sleep(self._config["searchtime_auto"]) # Assume that search results will arrive in this much time
-						if len(result)==0: continue # No results - cant do anything about that :(
-						if item["name"] is None: item["name"] = re.split("/",result[0][2].replace("\\","/") )[-1] # If name isnt provided, use the one from the first search result to arrive.
-						item["size"] = int(result[0][3]); # Set total file size, to be used during rebuilding
-						item["nick"] = self.unique(item["nick"]+[x[1] for x in result]) # Initialize/Expand source list, without redundancy
-						parts = int(math.ceil(float(item["size"])/self._config["segment_size"])) # Calculate number of blocks this file is not be divided into based on preconfigured block size.
+						if "size" not in item: # Sources and size have not been found yet
+							flag = True # No need to wait after one cycle
+							result = [] # List to hold search results from sources
+							self.search("TTH:"+item["id"],lambda x:result.append(x),{"type":"tth","mode":"auto"}) # Start a search for sources
+							time.sleep(self._config["searchtime_auto"]) # Assume that search results will arrive in this much time
+							if len(result)==0: continue # No results - cant do anything about that :(
+							if item["name"] is None: item["name"] = re.split("/",result[0][2].replace("\\","/") )[-1] # If name isnt provided, use the one from the first search result to arrive.
+							item["size"] = int(result[0][3]); # Set total file size, to be used during rebuilding
+							item["nick"] = self.unique(item["nick"]+[x[1] for x in result]) # Initialize/Expand source list, without redundancy
+						if self._config["verify_segments"] and item["size"]>self._config["segment_size"] and item["id"] not in self._trees: # Fetch the tree once, so that every segment can be verified as it arrives
+							pending = [i for i in self._queue if i["type"]=="tthl" and i["id"]==item["id"]]
+							if "tthl" not in item: # Not requested yet
+								item["tthl"] = time.time()
+								self._queue.append({"id":item["id"],"incomplete":item["id"]+".tthl","part":0,"parts":1,"type":"tthl","nick":item["nick"][:],"offset":0,"length":-1,"priority":1,"name":item["id"]+".tthl","size":-1,"location":None,"active":False,"considered":False,"success_callback":None,"success_callback_args":None,"failure_callback":None,"failure_callback_args":None})
+								continue
+							elif len(pending)>0 and time.time()-item["tthl"]<self._config["tthl_timeout"]: continue # Wait for the tree to arrive
+							elif len(pending)>0 and not pending[0]["active"]: self._queue.remove(pending[0]) # Give up on the tree, the file can still be verified when it is rebuilt.
+						segment = item["segment"] = self.transfer_segment(item) # Size of the parts, aligned to the nodes of the tree if available
+						parts = int(math.ceil(float(item["size"])/segment)) # Calculate number of blocks this file is not be divided into based on preconfigured block size.
 						if parts==0: # If the file is empty (size 0), write it now only.
 							open(self.transfer_filename(item),"wb").close() # Create and close an empty file.
 							continue # We can assume after this point that at least one part is present.
-						item["parts"] = parts; item["length"] = self._config["segment_size"] # Setting general infomration applicable to all parts, except last.
+						item["parts"] = parts; item["length"] = segment # Setting general infomration applicable to all parts, except last.
 						for part in range(parts-1): # Leaving out the last part, given that the length may be different.
-							item["part"] = part; item["offset"] = part*self._config["segment_size"]; # Set part-specific information
+							item["part"] = part; item["offset"] = part*segment; # Set part-specific information
 							self._queue.append(copy.deepcopy(item)) # All parts now have information all necessary information, and may now be treated individually.
-						item["part"] = parts-1; item["offset"] = (parts-1)*self._config["segment_size"]; # It is not necessary to append the last block again, as we can transform the current one into that.
-						item["length"] = ((item["size"]+self._config["segment_size"]-1)%self._config["segment_size"])+1 # Get the exact length of the last part
+						item["part"] = parts-1; item["offset"] = (parts-1)*segment; # It is not necessary to append the last block again, as we can transform the current one into that.
+						item["length"] = ((item["size"]+segment-1)%segment)+1 # Get the exact length of the last part
 						print "added "+str(parts)+" items"
 					if not self.transfer_verify(item): # Check whether or not this item has already been downloaded.
 						x = [i for i in self._queue if (item["id"]==i["id"] and "part" in i and item["part"]==i["part"])] # Isolate item with matching signature
@@ -540,7 +656,7 @@ class pydc_client():
 		return False # This object has not been verified for download, which means that it has already beeen downloaded, and rebuilding should be attempted.
 	def transfer_next(self,args,info): # Check if we need to download something from this peer
 		self._download["lock"].acquire() # Ensure that no other process is performing this procedure simultaneously. Thus, an inactive item selected will not become active unless it is done by this thread itself.
-		get = [item[1] for item in sorted([ (item["priority"],item) for item in self._queue if item["active"]==False and args["nick"] in item["nick"] ])] # Select inactive items which this peer can provide, decreasing priority
+		get = [item[1] for item in sorted([ (item["priority"],item) for item in self._queue if item["active"]==False and args["nick"] in item["nick"] and (item["type"]!="tthl" or len(args["support"])==0 or "TTHL" in args["support"]) ])] # Select inactive items which this peer can provide, decreasing priority
 		rebuild = []; # A list of items that have already been downloaded, and must be rebuilt.
 		while len(get)>0: # For each item in the list, check to see if it is viable for download
 			if self.transfer_verify(get[0]): # Return true if we can start the download.
@@ -567,38 +683,91 @@ class pydc_client():
 				suffix+= 1; filename = location+os.sep+item["name"]+" ("+str(suffix)+")"+extn; # Add the incremented suffix to the base filename
 		# NOTICE : In Linux, also need to ensure that we have the required permissions in the target location.
 		return filename # This file is guaranteed to be accessible and writable.
-	def transfer_rebuild(self,get): # Called when all parts of a file are downloaded, to join them and make a whole file
+	def transfer_segment(self,item): # Calculates the size of the parts a file is to be split into
+		segment = self._config["segment_size"]
+		tree = self._trees.get(item["id"]) if item["type"]=="tth" else None # (filesize, level, nodes)
+		if tree is not None: # Round up to a multiple of the data covered by one node, so that each part can be verified on its own
+			block = tigertree.TigerTree.blocksize<<tree[1]
+			segment = (segment+block-1)/block*block
+		return segment
+	def transfer_verifier(self,get): # Returns a tree to which the data of a part is fed as it arrives, or None if it cannot be verified
+		if not self._config["verify_segments"] or get["type"]!="tth" or "segment" not in get: return None
+		tree = self._trees.get(get["id"])
+		if tree is None or get["segment"]%(tigertree.TigerTree.blocksize<<tree[1])!=0: return None # No tree, or parts not aligned to its nodes
+		verifier = tigertree.TigerTree(lanes=self._config["hash_lanes"],level=tree[1])
+		tempname = self._dir["incomplete"]+os.sep+get["incomplete"]+".part"+str(get["part"])
+		if os.path.isfile(tempname): # Data that arrived before the download was interrupted
+			handle = open(tempname,"rb")
+			while True:
+				data = handle.read(self._config["hash_buffer"])
+				if data=="": break
+				verifier.update(data)
+			handle.close()
+		return verifier
+	def transfer_check(self,get,verifier): # Compares the nodes calculated for a complete part with those of the stored tree
+		size,level,nodes = self._trees.get(get["id"])
+		first = get["part"]*get["segment"]/(tigertree.TigerTree.blocksize<<level) # Index of the first node covered by this part
+		actual = verifier.nodes()
+		return actual==nodes[first*24:first*24+len(actual)]
+	def transfer_corrupt(self,get,nick): # Called when a downloaded part does not match the tree of the file, to discard and requeue it
+		self.debug("Part "+str(get["part"])+" of "+get["id"]+" from "+nick+" does not match the tree of the file; downloading it again.")
+		tempname = self._dir["incomplete"]+os.sep+get["incomplete"]+".part"+str(get["part"])
+		try: os.remove(tempname)
+		except EnvironmentError: pass
+		get["offset"] = get["part"]*get["segment"]; get["length"] = min(get["segment"],get["size"]-get["offset"]) # Undo the adjustments made while resuming
+		if nick in get["nick"] and len(get["nick"])>1: get["nick"].remove(nick) # Prefer other sources for this part
+		get["active"] = False; get["considered"] = False
+		return self
+	def transfer_tthl(self,get): # Called when the tree of a queued file has been downloaded, to validate and store it
+		tempname = self._dir["incomplete"]+os.sep+get["incomplete"]+".part"+str(get["part"])
+		try:
+			handle = open(tempname,"rb"); nodes = handle.read(); handle.close()
+			os.remove(tempname)
+		except EnvironmentError: return False
+		size = [item["size"] for item in self._queue if item["type"]=="tth" and item["id"]==get["id"] and "size" in item]
+		if len(size)==0: return False # The file is no longer queued
+		tree = tigertree.root(nodes,size[0]) # (level, root) if the nodes make up a level of a tree for a file of this size
+		if tree is None or base64.b32encode(tree[1])[:-1]!=get["id"]:
+			self.debug("Discarding invalid tree for "+get["id"]+" from "+str(get["nick"]))
+			return False
+		self._trees.put(get["id"],size[0],tree[0],nodes)
+		self.debug("Tree received for "+get["id"]+" ("+str(len(nodes)/24)+" nodes)")
+		return True
+	def transfer_rebuild(self,get): # Called when all parts of a file are downloaded, to join them and make a whole file; returns True if that was done and the TTH matched
 		more = False # Do more parts of the file exist in the download queue?
 		for item in self._queue: # For each item in the download queue, check the ID and the Name attr to identify other parts
 			if item["incomplete"]==get["incomplete"] and item["name"]==get["name"]: more = True # Found another part
 		all = True # Have all parts been downloaded and are complete in size?
 		tempname = self._dir["incomplete"]+os.sep+get["incomplete"]; # Generate the temporary name to be used multiple times later
+		segment = get["segment"] if "segment" in get else self._config["segment_size"] # Size of all parts but the last
 		if not more: # If there arent more parts to be downloaded
-			residue = ((get["size"]+self._config["segment_size"]-1)%self._config["segment_size"]+1) # Calculate the size of the last block
+			residue = ((get["size"]+segment-1)%segment+1) # Calculate the size of the last block
 			for i in range(get["parts"]):
 				filesize = os.path.getsize(tempname+".part"+str(i)) if os.path.isfile(tempname+".part"+str(i)) else -1
-				if get["type"]=="file":
+				if get["type"] in ("file","list"):
 					pass # Leave filelists alone as they are always assumed to be one block.
 				elif filesize==-1:
 					all = False
-					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*self._config["segment_size"];
-					redownload["length"] = self._config["segment_size"] if i<get["parts"]-1 else residue; self._queue.append(redownload);
-				elif i<get["parts"]-1 and filesize!=self._config["segment_size"]:
+					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*segment;
+					redownload["length"] = segment if i<get["parts"]-1 else residue; self._queue.append(redownload);
+				elif i<get["parts"]-1 and filesize!=segment:
 					all = False;
-					if filesize>self._config["segment_size"]:
+					if filesize>segment:
 						os.remove(tempname+".part"+str(i)); filesize = 0;
-					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*self._config["segment_size"]+filesize;
-					redownload["length"] = self._config["segment_size"]-filesize; self._queue.append(redownload);
+					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*segment+filesize;
+					redownload["length"] = segment-filesize; self._queue.append(redownload);
 				elif i==get["parts"]-1 and filesize!=residue:
 					all = False;
 					if filesize>residue:
 						os.remove(tempname+".part"+str(i)); filesize = 0;
-					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*self._config["segment_size"]+filesize;
+					redownload = copy.deepcopy(get); redownload["part"] = i; redownload["offset"] = i*segment+filesize;
 					redownload["length"] = residue-filesize; self._queue.append(redownload);
 		if not more and all: # If no more parts are to be downloaded, and all parts are available.
 			filename = self.transfer_filename(get) # Obtain the destination file name
 			get["filename"] = filename
-			handle_dest = open(filename,"wb") # Create file at new location, and manual transfer data from the temp location to that.
+			rebuildname = tempname+".rebuild" # The file is assembled here, and moved to its destination only after it has been verified.
+			tree = tigertree.TigerTree(lanes=self._config["hash_lanes"]) if get["type"]=="tth" else None # The TTH is calculated while the parts are joined, so that the file neednt be read again.
+			handle_dest = open(rebuildname,"wb") # Create file at temporary location, and manual transfer data from the parts to that.
 			for i in range(get["parts"]):
 				handle_src = open(tempname+".part"+str(i),"rb")
 				blocksize = 1024*1024 # 1 MB blocks
@@ -606,6 +775,7 @@ class pydc_client():
 					datablock = handle_src.read(blocksize) 
 					if datablock=="": break
 					handle_dest.write(datablock)
+					if tree is not None: tree.update(datablock)
 				handle_src.close()
 			handle_dest.close()
 			for i in range(get["parts"]): # Delete all source parts
@@ -614,40 +784,66 @@ class pydc_client():
 						os.remove(tempname+".part"+str(i))
 						break
 					except WindowsError: time.sleep(1)
+			if tree is not None and tree.base32()!=get["id"]: # The file does not match the TTH it was queued under
+				quarantine = self._dir["quarantine"]+os.sep+get["id"]+" "+os.path.basename(filename)
+				shutil.move(rebuildname,quarantine)
+				self.debug("Download failed verification : "+filename+" (Expected TTH: "+get["id"]+", Actual TTH: "+tree.base32()+"), moved to "+quarantine)
+				if get["failure_callback"]!=None:
+					try:
+						if get["failure_callback_args"]!=None: get["failure_callback"](get["failure_callback_args"])
+						else: get["failure_callback"]()
+					except:
+						self.debug("Failure Callback Function Error : "+str(get))
+						exc_type, exc_value, exc_traceback = sys.exc_info()
+						traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=(sys.stdout))
+				return False
+			shutil.move(rebuildname,filename)
 			filesize = os.path.getsize(filename)
 			self.debug("Download complete : "+filename+" (FileSize: "+self.filesize(filesize)+")")	
 			if get["location"]==self._dir["filelist"] and get["id"]==self._config["filelist"]: # Identify Filelists
 				if self.bz2_compress(filename,False): os.remove(filename) # Decompress filelists
+			return True # Rebuilt, and verified where possible
+		return False # Parts are still missing
 	def transfer_request(self,args,info): # Make the actual download request
 		self.debug("Requesting "+str(args["get"])+" from "+args["nick"]+" ("+info["host"]+":"+str(info["port"])+") ...")
 		tempname = self._dir["incomplete"]+os.sep+self.escape_filename(args["get"]["incomplete"])+".part"+str(args["get"]["part"])
 		try: # If the part file already exists as the result of an interrupted download, resume, instead of restarting.
-			if os.path.isfile(tempname):
+			if os.path.isfile(tempname) and args["get"]["type"]=="tthl": os.remove(tempname) # Trees are always requested whole
+			elif os.path.isfile(tempname):
 				filesize = os.path.getsize(tempname)
 				args["get"]["offset"] += filesize
 				args["get"]["length"] -= filesize
 		except: pass
+		if args["get"]["type"]=="list": return "$ADCGET list "+self.escape_adc(args["get"]["id"])+" 0 -1"+(" RE1" if args["get"]["recursive"] else "")+"|" # Partial filelists are always requested whole, and uncompressed
 		return "$ADCGET "+("file" if args["get"]["type"]=="tth" else args["get"]["type"])+" "+("TTH/" if args["get"]["id"]!=self._config["filelist"] else "")+args["get"]["id"]+" "+str(args["get"]["offset"])+" "+str(args["get"]["length"])+(" ZL1" if "ZLIG" in args["support"] else "")+"|"
 	def transfer_download(self,args,info): # Read the connection buffer for new binary data, and save it.
 		length = min(len(args["buffer"]),args["more"])
 		args["handle"].write(args["buffer"][:length])
 		args["handle"].flush()
+		if args["verify"] is not None: args["verify"].update(args["buffer"][:length]) # Hash the part as it streams in
 		args["buffer"] = args["buffer"][length:]
 		args["more"]-=length
 		if args["more"]==0:
 			self.debug("Download complete : "+str(args["get"])+" from "+info["host"]+":"+str(info["port"])+".")
 			args["binary"] = False; args["handle"].close(); # Free up one download slot, enable writing to debug stream again and close file
-			x = [item for item in self._queue if (item["id"]==args["get"]["id"] and item["incomplete"]==args["get"]["incomplete"] and item["part"]==args["get"]["part"])] # Isolate item with matching signature
-			if len(x)==1 and x[0] in self._queue: self._queue.remove(x[0]) # Remove item from queue
-			self.transfer_rebuild(args["get"]) # Try rebuilding
-			if args["get"]["success_callback"]!=None:
-				try:
-					if args["get"]["success_callback_args"]!=None: args["get"]["success_callback"](args["get"]["filename"], args["get"]["success_callback_args"])
-					else: args["get"]["success_callback"](args["get"]["filename"])
-				except:
-					self.debug("Success Callback Function Error : "+str(args["get"]))
-					exc_type, exc_value, exc_traceback = sys.exc_info()
-					traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=(sys.stdout))
+			corrupt = args["verify"] is not None and not self.transfer_check(args["get"],args["verify"]) # Compare the part with the tree of the file
+			args["verify"] = None
+			if corrupt: self.transfer_corrupt(args["get"],args["nick"]) # Discard and requeue only this part
+			elif args["get"]["type"]=="tthl": # Tree of a queued file
+				if args["get"] in self._queue: self._queue.remove(args["get"]) # Remove item from queue
+				self.transfer_tthl(args["get"]) # Validate and store it
+			else:
+				x = [item for item in self._queue if (item["id"]==args["get"]["id"] and item["incomplete"]==args["get"]["incomplete"] and item["part"]==args["get"]["part"])] # Isolate item with matching signature
+				if len(x)==1 and x[0] in self._queue: self._queue.remove(x[0]) # Remove item from queue
+				rebuilt = self.transfer_rebuild(args["get"]) # Try rebuilding
+				if rebuilt and args["get"]["success_callback"]!=None: # Only once the whole file is available and verified
+					try:
+						if args["get"]["success_callback_args"]!=None: args["get"]["success_callback"](args["get"]["filename"], args["get"]["success_callback_args"])
+						else: args["get"]["success_callback"](args["get"]["filename"])
+					except:
+						self.debug("Success Callback Function Error : "+str(args["get"]))
+						exc_type, exc_value, exc_traceback = sys.exc_info()
+						traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=(sys.stdout))
 			del args["get"] # Destroy the last reference to that queue item
 			args["get"] = self.transfer_next(args,info) # Try and select the next item to download
 			if args["get"] is not None: info["send"](self.transfer_request(args,info) ) # If there is such an item, start the download
@@ -656,27 +852,18 @@ class pydc_client():
 				info["close"]() # Or else, terminate connection.
 		return args, info
 	def transfer_upload(self,args,info,x): # Response to an ADCGET Request;
+		group = self.group_find(args["nick"]) # Calculate the group
+		if x[1]=="tthl": return self.transfer_upload_tthl(args,info,x,group) # Tree data is small, and is served without using up a slot
+		if x[1]=="list": return self.transfer_upload_list(args,info,x,group) # As are partial filelists
 		if self._download["upslots"]==self._download["maxupslots"]:
 			info["send"]("$Error All download slots already taken.|")
 			return args,info
-		group = self.group_find(args["nick"]) # Calculate the group
 		if x[1]=="file" and x[2]==self._config["filelist"]: # If its a filelist
 			target = self._dir["filelist"]+os.sep+"#"+self.escape_filename(group,True)+".xml.bz2" # Select the appropriate on
 		elif x[1]=="file" and x[2].startswith("TTH/"): # If its a TTH specified file download
-			filelist = self._shared[group].getElementsByTagName("FileListing")[0] # Select the appropriate filelist
-			result = self.search_result_recursive(filelist,(None,None,"F","F",0,9,x[2][4:]),os.sep) # <ip>/<hub>, <port>/<nick>, isSizeRestricted, isMaxSize, size, fileType, searchTerm
-			if len(result)==0: # No Results
+			target = self.transfer_upload_path(group,x[2][4:]) # Only files shared with this group may be requested
+			if target is None: # No Results
 				info["send"]("$Error File not found.|"); return args,info
-			else: # TTH Results were found.
-				target = result[0][0] # File Name relative to the paths added to the filelist
-				for path in self._filelist[group]:
-					if os.path.isdir(path): # If the path is a directory
-						if path.endswith(os.sep): path = path[:-1] # Remove the trailing slash
-						z = os.sep.join(path.split(os.sep)[:-1])+os.sep+target # Remove the folder name from the base path, as it appears in the final path too.
-						if os.path.isfile(z): # Verify that the file indeed exists
-							target = z; break # Target it and break out of the loop
-					elif os.path.isfile(path) and path.endswith(target): # If the file was directly shared,
-						target = path; break # Target and break out
 		else:
 			info["send"]("$Error Unsupported Request|")
 			return args,info
@@ -696,13 +883,51 @@ class pydc_client():
 		handle.close()
 		self._download["upslots"]-=1
 		return args,info
+	def transfer_upload_path(self,group,tth): # Returns the path on disk of a file with the given TTH that is shared with a group, or None if there is none that is unchanged since it was hashed
+		try: root = base64.b32decode(tth+"=")
+		except TypeError: return None
+		stale = [] # Copies that have been modified, replaced or removed since they were hashed, as (entry, share.Record or None) pairs
+		for path,size,mtime,entry in self._share.paths(self.group_mask(group),root):
+			record = share.record(path)
+			if record is not None and record.size==size and (mtime==0 or record.mtime==mtime): return path # Files read from a filelist have no modification time
+			stale.append((entry,record))
+		if len(stale)>0: self.hash_stale(stale)
+		return None
+	def transfer_upload_tthl(self,args,info,x,group): # Response to an ADCGET Request for the tree (leaves or a higher level) of a shared file
+		tree = self._trees.get(x[2][4:]) if x[2].startswith("TTH/") else None # (filesize, level, nodes) as saved by tth_generate
+		if tree is None or len(self.search_result_index(self._share,self.group_mask(group),(None,None,"F","F",0,9,x[2][4:]),1))==0: # Only files shared with this group may be requested
+			info["send"]("$Error File Not Available|")
+			return args,info
+		x = x[:5]; x[3] = "0"; x[4] = str(len(tree[2])) # The whole level is always sent, uncompressed
+		info["send"]("$ADCSND "+" ".join(x[1:])+"|")
+		args["binary"] = True
+		info["send"](tree[2])
+		args["binary"] = False
+		return args,info
+	def transfer_upload_list(self,args,info,x,group): # Response to an ADCGET Request for a partial filelist : the contents of a directory in the share of the group, down to list_depth levels (or all of them, if RE1 is given), uncompressed
+		names = [name for name in x[2].split("/") if name!=""]
+		if not x[2].startswith("/"):
+			info["send"]("$Error File Not Available|")
+			return args,info
+		tree = self._share
+		directory = tree.locate(self.group_mask(group),names) # Readers see the committed view, so the share need not be locked
+		if directory is None:
+			info["send"]("$Error File Not Available|")
+			return args,info
+		base = "/"+"".join([name+"/" for name in names])
+		data = "".join(tree.xml(self._config["cid"],self._config["signature"],None,directory,base,(None if "RE1" in x[5:] else self._config["list_depth"])))
+		info["send"]("$ADCSND list "+self.escape_adc(base)+" 0 "+str(len(data))+"|")
+		args["binary"] = True
+		info["send"](data)
+		args["binary"] = False
+		return args,info
 	def transfer_handler(self,data,info,args): # Client-to-Client Handshake: Responds to data from remote host
 		if data is None:
 			if "host" not in args["transfer"]: args["transfer"]["host"]=info["host"]
 			if "port" not in args["transfer"]: args["transfer"]["port"]=info["port"]
 			if "buffer" not in args: # Initializations to be done when a TCP connection has just been set up.
 				if args["role"]=="client": info["send"]("$MyNick "+self.escape(self._config["nick"])+"|")
-				args = {"buffer":"", "binary":False, "support":[], "role":args["role"], "transfer":args["transfer"], "get":None, "error":False }
+				args = {"buffer":"", "binary":False, "support":[], "role":args["role"], "transfer":args["transfer"], "get":None, "error":False, "verify":None }
 			else: # Destructor
 				if args["get"] is not None and not args["error"]:
 					self.spawn("RemoteConnection:"+args["nick"],self.connect_remote,(args["nick"],True))
@@ -720,7 +945,7 @@ class pydc_client():
 					continue
 				data = args["buffer"][0:length]
 				args["buffer"] = args["buffer"][length+1:]
-				x = data.split()
+				x = self.split_adc(data) if data.startswith("$ADC") else data.split() # Identifiers in ADC commands may contain escaped spaces
 				if x[0]=="$MyNick":
 					args["nick"] = x[1]
 					self._userips[args["nick"]] = info["host"]
@@ -752,6 +977,8 @@ class pydc_client():
 					if args["get"] is not None and (args["dir"]=="Upload" or args["rand1"]>args["rand2"]): # If peer doest want to download, or if its random number is smaller, we can download
 						info["send"](self.transfer_request(args,info))
 					if args["get"] is not None and args["dir"]=="Upload": info["kill"]() # Neither side wants to download, so break the connection
+				elif x[0]=="$ADCGET" and len(x)>4 and x[1]=="tthl": # Tree data only allows peers to verify what they already have, and is served even though uploads are disabled.
+					args,info = self.transfer_upload(args,info,x)
 				elif x[0]=="$ADCGET":
 					# args,info = self.transfer_upload(args,info,x) # All uploads currently disabled.
 					info["send"]("$Error You do not have the Access Level to download anything from SheriffBot.|") # SHERIFFBOT
@@ -770,6 +997,7 @@ class pydc_client():
 					args["more"] = int(x[4])
 					if args["get"]["size"]==-1: args["get"]["size"] = int(x[4])
 					args["binary"] = True
+					args["verify"] = self.transfer_verifier(args["get"]) # Tree to which the data is fed as it arrives, if the part can be verified
 					args["handle"] = open( self._dir["incomplete"]+os.sep+args["get"]["incomplete"]+".part"+str(args["get"]["part"]),"ab")
 					self.debug("Starting download : "+str(args["get"])+" from "+info["host"]+":"+str(info["port"])+".")
 					args,info = self.transfer_download(args,info)
@@ -781,6 +1009,7 @@ class pydc_client():
 					args["error"] = True
 					args["get"]["active"] = False
 					self._download["downslots"]-=1
+					if args["get"]["type"]=="tthl" and args["get"] in self._queue: self._queue.remove(args["get"]) # The peer cannot provide the tree, so carry on without it
 					if args["get"]["failure_callback"]!=None:
 						try:
 							if args["get"]["failure_callback_args"]!=None: args["get"]["failure_callback"](args["get"]["failure_callback_args"])
@@ -812,20 +1041,109 @@ class pydc_client():
 				if key=="mode" and options[key] in ("manual","auto"): mode = options[key] # Search Mode
 		if "display" not in options: options["display"] = None # Assuming the results are not to be sent to a stream.
 		ss = "?".join(ss) # Combining all parameters into a search pattern
-		self._search[ss] = { "mode":mode, "result":result } # Creating a search pseudo object, so that we can keep track of associated information
+		self._listener["lock"].acquire()
+		try:
+			self._search[ss] = { "mode":mode, "result":result, "expires":time.time()+self._config["searchtime_"+mode] } # Creating a search pseudo object, so that we can keep track of associated information
+			self.search_expire() # Results are accepted until the search expires
+			if self._config["mode"]: port = self.search_listener_start() # Active Mode : Results of all searches arrive at the same port, and are told apart by their contents
+		finally: self._listener["lock"].release()
 		if self._config["mode"]: # Active Mode
-			port = random.randint(0,2**16-1) # Choose a random
-			while True: # Keep trying till a free port is found
-				try: # Connection constructor might raise an exception
-					c = Connection({"name":ss,"host":self._config["localhost"],"port":port,"role":"server","type":"udp","handler":self.search_result_process,"args":{"ss":ss,"buffer":""},"debug":self._debug}) # Create a UDP server to listen for Search Results
-					break # Stop only when the server has been setup
-				except ConnectionError: port = random.randint(0,2**16-1) # Try another random port
-			self._search[ss]["socket"] = c # Save the connection into the search object
 			self._socket.send("$Search %s:%d %s|" % (self._config["localhost"],port,ss)) # Send a search command to the hub that will be echoed to all other clients
-			self.spawn("SearchTimeout:"+ss,lambda:( time.sleep(self._config[ "searchtime_"+mode ]), c.close() )) # Stop listening for search results after specific amount of time
 		else: # Passive Mode
-			self._socket.send("$Search Hub:%s %s|" % (self._config["nick"],ss)) # Send a search command to the hub to be echoed to all peers.
-			self._search[ss]["socket"] = None # Given passive connections, a limited number of results will be sent back via the hub only, so no dedicated connection is required.
+			self._socket.send("$Search Hub:%s %s|" % (self._config["nick"],ss)) # Send a search command to the hub to be echoed to all peers. Given passive connections, a limited number of results will be sent back via the hub only, so no dedicated connection is required.
+		return self
+	def search_listener_start(self): # Sets up the UDP server at which the results of active mode searches are received, if it isnt running already, and returns its port
+		self._listener["lock"].acquire()
+		try:
+			if self._listener["socket"] is not None and self._listener["socket"].active(): return self._listener["port"]
+			port = self._config["search_port"] or random.randint(1024,2**16-1) # Choose a random port, unless one has been configured
+			for attempt in range(100): # Keep trying till a free port is found
+				try: # Connection constructor might raise an exception
+					c = Connection({"name":"SearchListener","host":self._config["localhost"],"port":port,"role":"server","type":"udp","handler":self.search_result_process,"args":{},"buffer":65535,"debug":self._debug}) # Create a UDP server to listen for Search Results; datagrams longer than the buffer would be cut short, and may hold several results
+					if c.active(): break # Stop only when the server has been setup
+				except ConnectionError: pass
+				port = random.randint(1024,2**16-1) # Try another random port
+			else: raise ConnectionError("SearchListener",5,"Could not bind to any UDP port to receive search results.")
+			self._listener["socket"] = c; self._listener["port"] = port
+			self.debug("Listening for search results at UDP port "+str(port))
+			return port
+		finally: self._listener["lock"].release()
+	def search_listener_stop(self): # Closes the UDP server receiving search results, and forgets all searches
+		self._listener["lock"].acquire()
+		try:
+			if self._listener["timer"] is not None: self._listener["timer"].cancel()
+			self._listener["timer"] = None
+			self._search.clear()
+			c = self._listener["socket"]; self._listener["socket"] = None
+			if self._listener["sender"] is not None: self._listener["sender"].close()
+			self._listener["sender"] = None
+		finally: self._listener["lock"].release()
+		if c is not None and c.active(): c.close()
+		return self
+	def search_expire(self): # Removes the searches whose time is up, and sets the timer to be run again when the next one expires
+		self._listener["lock"].acquire()
+		try:
+			now = time.time()
+			for ss in [ss for ss in self._search if self._search[ss]["expires"]<=now]: del self._search[ss]
+			if self._listener["timer"] is not None: self._listener["timer"].cancel()
+			self._listener["timer"] = None
+			if len(self._search)>0:
+				self._listener["timer"] = threading.Timer(max(min([item["expires"] for item in self._search.values()])-now,0),self.search_expire)
+				self._listener["timer"].daemon = True # Does not keep the client alive
+				self._listener["timer"].start()
+		finally: self._listener["lock"].release()
+		return self
+	def search_responder_enqueue(self,request): # Queues a $Search request from another user to be answered by the responder threads, subject to the queue size and rate limits
+		address = request.split(" ",2)[1] if request.count(" ")>=2 else ""
+		source = address if address.startswith("Hub:") else address.rsplit(":",1)[0] # Nick in passive mode, IP Address in active mode
+		self._responder["lock"].acquire()
+		try:
+			if time.time()-self._responder["window"]>=1: # New rate limiting period
+				self._responder["window"] = time.time(); self._responder["sources"] = {}
+			if self._config["search_rate"]>0 and self._responder["sources"].get(source,0)>=self._config["search_rate"]:
+				self._responder["limited"] += 1
+				return self
+			self._responder["sources"][source] = self._responder["sources"].get(source,0)+1
+			while len(self._responder["queue"])>=max(self._config["search_queue"],1): # Older searches are the least likely to be still waiting for results
+				self._responder["queue"].popleft(); self._responder["dropped"] += 1
+			self._responder["queue"].append(request)
+			self._responder["lock"].notify()
+		finally: self._responder["lock"].release()
+		return self.search_responder_start()
+	def search_responder_start(self): # Starts the responder threads, if they arent running already
+		self._responder["lock"].acquire()
+		try:
+			self._responder["threads"] = [thread for thread in self._responder["threads"] if thread.is_alive()]
+			self._responder["active"] = True
+			for i in range(len(self._responder["threads"]),max(self._config["search_workers"],1)):
+				self._responder["threads"].append(self.spawn("SearchResponder",self.search_responder))
+		finally: self._responder["lock"].release()
+		return self
+	def search_responder_stop(self): # Stops the responder threads once they have answered the searches they are working on; queued searches are discarded
+		self._responder["lock"].acquire()
+		self._responder["active"] = False
+		self._responder["queue"].clear()
+		self._responder["lock"].notify_all()
+		self._responder["lock"].release()
+		for thread in self._responder["threads"]:
+			if thread is not threading.current_thread(): thread.join()
+		self._responder["threads"] = []
+		return self
+	def search_responder_status(self): # Returns the status of the responder threads
+		return {"queue":len(self._responder["queue"]), "answered":self._responder["answered"], "dropped":self._responder["dropped"], "limited":self._responder["limited"], "hits":self._responder["hits"], "misses":self._responder["misses"], "cached":len(self._responder["cache"]), "active":len([thread for thread in self._responder["threads"] if thread.is_alive()])}
+	def search_responder(self): # A loop that answers queued searches, one at a time, until search_responder_stop is called
+		while True:
+			self._responder["lock"].acquire()
+			try:
+				while self._responder["active"] and len(self._responder["queue"])==0: self._responder["lock"].wait(1)
+				if not self._responder["active"]: break
+				request = self._responder["queue"].popleft()
+			finally: self._responder["lock"].release()
+			try: self.search_result_generate(request)
+			except Exception, e: self.debug("Could not answer search request : "+request+" : "+str(e)) # eg: The hub connection was lost
+			self._responder["lock"].acquire()
+			self._responder["answered"] += 1
+			self._responder["lock"].release()
 		return self
 	def search_result_generate(self,request):
 		info = None # Represents that the search pattern is as of now, unrecognized
@@ -854,71 +1172,84 @@ class pydc_client():
 					hits+=1 # Keep track of number of candidates
 			if hits>1: group = self._config["group_base"] # Multiple nicks with same IP, ambiguous situation
 		else: group = self.group_find(info[1]) # Passive Case, nick provided
-		try: filelist = self._shared[group].getElementsByTagName("FileListing")[0] # Based on the user, select the appropriate filelist
-		except: return self # XXX 20120316 : IndexError list index out of range error
-		result = self.search_result_recursive(filelist,info,os.sep) # Search though it; returns a list of results, in tuple form
+		result = self.search_result_cached(group,info) # Based on the user, search the appropriate part of the share; returns a list of results, in tuple form
 		if len(result)==0: return self # If there arent any result, give up and die.
 		random.shuffle(result); result = result[:self._config["sr_count"]] # Randomly select a small number of results
 		for i in range(len(result)): # Appropriately format the results
 			if len(result[i])==3: result[i] = "$SR "+self._config["nick"]+" "+result[i][0]+chr(5)+str(result[i][1])+" "+str(self._download["upslots"])+"/"+str(self._download["maxupslots"])+chr(5)+"TTH:"+result[i][2]+" ("+self._config["host"]+":"+str(self._config["port"])+")"+(chr(5)+info[1] if not mode else "")+"|" # File Result
 			elif len(result[i])==1: result[i] = "$SR "+self._config["nick"]+" "+result[i][0]+" "+str(self._download["upslots"])+"/"+str(self._download["maxupslots"])+chr(5)+self._config["hubname"]+" ("+self._config["host"]+":"+str(self._config["port"])+")"+(chr(5)+info[1] if not mode else "")+"|" # Directory Result
-		if mode: # Active Mode
-			target = Connection({"name":"SearchResult","host":info[0],"port":info[1],"role":"client","type":"udp","debug":self._debug}) # Link to send the results
-			for line in result: target.send(line) # Sequentially, send the results
+		if mode: self.search_result_send(info[0],int(info[1]),result) # Active Mode
 		else: # Passive Mode
 			for line in result: self._socket.send(line) # Send results to the hub
 		return self
-	def search_result_recursive(self,current,info,path):
-		result = [] # The list to be returned
+	def search_result_send(self,host,port,lines): # Sends $SR lines to an active mode user, one per UDP datagram, or packed into as few datagrams as udp_mtu allows if sr_pack is set
+		sender = self._listener["sender"]
+		if sender is None:
+			self._listener["lock"].acquire()
+			try:
+				if self._listener["sender"] is None: self._listener["sender"] = socket.socket(socket.AF_INET,socket.SOCK_DGRAM) # sendto is safe to call from several threads at once
+				sender = self._listener["sender"]
+			finally: self._listener["lock"].release()
+		datagrams = []
+		for line in lines:
+			if len(datagrams)>0 and self._config["sr_pack"] and len(datagrams[-1])+len(line)<=self._config["udp_mtu"]: datagrams[-1] += line
+			else: datagrams.append(line) # Results longer than udp_mtu are sent in datagrams of their own
+		try:
+			for datagram in datagrams: sender.sendto(datagram,(host,port))
+		except socket.error, e: self.debug("Could not send search results to "+host+":"+str(port)+" : "+str(e))
+		return self
+	def search_result_cached(self,group,info): # Returns a new list of (up to sr_count) results of a search from a user of the given group, as search_result_index does, remembering the most recent ones until the share changes
+		if info[5]==9: term = info[6].upper() # Base32
+		else: term = " ".join(sorted(set(info[6].lower().split()))) # Word order and case do not affect matches
+		key = (group,info[2],info[3],(info[4] if info[2]=="T" else ""),info[5],term)
+		tree = self._share
+		version = tree.version # Read before searching, so that results from an older share are never saved as current
+		self._responder["lock"].acquire()
+		try:
+			if self._responder["version"]!=version: # The share has been committed since : Results may have changed
+				self._responder["cache"].clear(); self._responder["version"] = version
+			result = self._responder["cache"].pop(key,None)
+			if result is not None:
+				self._responder["cache"][key] = result # Most recently used
+				self._responder["hits"] += 1
+				return list(result)
+			self._responder["misses"] += 1
+		finally: self._responder["lock"].release()
+		result = self.search_result_index(tree,self.group_mask(group),info,self._config["sr_count"])
+		self._responder["lock"].acquire()
+		try:
+			if self._config["search_cache"]>0 and self._responder["version"]==version:
+				self._responder["cache"][key] = tuple(result)
+				while len(self._responder["cache"])>self._config["search_cache"]: self._responder["cache"].popitem(False) # Least recently used
+		finally: self._responder["lock"].release()
+		return result
+	def search_result_index(self,tree,mask,info,limit=None): # Searches the files and directories of a share.ShareTree visible to the groups in a bitmask, using its index; returns up to limit results, in tuple form
 		# The info variable is a list of data in the format: <ip>/<hub>, <port>/<nick>, isSizeRestricted, isMaxSize, size, fileType, searchTerm
-		for node in current.childNodes: # Loop through all items of the current directory
-			if info[5]!=8 and str(node.nodeName)=="File": # Select only filenames
-				nextloop = False # A flag for when the outer loop is to be controlled by an inner loop
-				name = node.getAttribute("Name"); size = int(node.getAttribute("Size")); tth = node.getAttribute("TTH"); limit = int(info[4]); # These variables will be used later on
-				if info[5]==9 and tth!=info[6]: continue # TTH Search and mismatch
-				if info[5]!=9: # Non-TTH Searches
-					name2 = name.lower() # Make patterns case insensitive
-					for word in info[6].lower().split(): # For each word in the search term
-						try:
-							if name2.count(word)==0: # Check if this filename contains it
-								nextloop = True; break # If yes, break out
-						except UnicodeDecodeError: pass # DEBUG : Only ASCII allowed.
-				if nextloop: continue # If there were no matches, move on to the next file
-				if info[2]=="T": # There is a size limit
-					if info[3]=="T" and size>limit: continue# Maximum Size Limit
-					elif size<limit: continue # Minimum Size Limit
-				if info[5]>1 and info[5]<8: # If a specific file type was requested
-					for ext in self._fileextn[info[5]].split(): # For each extension in that file type group
-						if name.endswith("."+ext): # Check if it is at the end of the filename
-							nextloop = True; break # If yes, no need to check more
-				else: nextloop = True; # This criterion does not applu
-				if not nextloop: continue # If no, move on.
-				result+=[(path[1:]+name,size,tth)] # All has gone well till now, so add it to the results.
-			elif str(node.nodeName)=="Directory": # Select only directories
-				nextloop = False # Flag
-				name = node.getAttribute("Name") # Accesses multiple times later
-				result+=self.search_result_recursive(node,info,path+name+os.sep) # Search through the directory itself
-				if info[5] not in (1,8): continue # Folders dont have TTH or types
-				name2 = name.lower() # case insensitive
-				for word in info[6].lower().split(): # for each word in search term
-					if name2.count(word)==0: # see if directory name has it
-						nextloop = True; break # if yes, stop searching
-				if nextloop: continue # if no, move on
-				result+=[(path[1:]+name)] # directory match, add to results
+		limited = info[2]=="T" and info[4]!="" # Size limit
+		minimum = int(info[4]) if limited and info[3]!="T" else None; maximum = int(info[4]) if limited and info[3]=="T" else None
+		if info[5]==9: # TTH Search : Compare the 24 byte roots rather than encoding every one of them
+			try: entries = tree.search_root(mask,base64.b32decode(info[6]+"="))
+			except TypeError: entries = []
+			entries = [entry for entry in entries if (minimum is None or tree.size(entry)>=minimum) and (maximum is None or tree.size(entry)<=maximum)][:limit]
+		else:
+			entries = tree.search(mask,info[6].lower().split(),
+				(set(self._fileextn[info[5]].split()) if info[5]>1 and info[5]<8 else None), # Allowed extensions for specific filetypes
+				minimum,maximum,info[5]!=8,info[5] in (1,8),limit) # Folders dont have TTH or types
+		result = []; seen = set()
+		for entry in entries:
+			path = os.sep.join(tree.path(entry)[1:]) # Relative to the top of the filelist
+			if path in seen: continue # Directories of the same name are merged in filelists
+			seen.add(path)
+			result.append((path,tree.size(entry),tree.tth(entry)) if not tree.directory(entry) else (path,))
 		return result
 	def search_result_process(self,data,info=None,args=None):
 		# if self._search[ss]["result"] is not None: print >>self._search[ss]["result"],"Search Result [%s] : %s" % (pattern,data)
 		if data is None: return args
-		if args is None: # Passive
-			for ss in self._search:
-				self.search_result_forward(ss,str(data),True)
-		else: # Active
-			args["buffer"]+=data
-			for iteration in range(data.count("|")):
-				length = args["buffer"].index("|")
-				data = args["buffer"][:length]
-				args["buffer"] = args["buffer"][length+1:]
-				self.search_result_forward(args["ss"],data,False)
+		if args is None: lines = [str(data)] # Passive : A single result, relayed by the hub
+		else: lines = data.split("|")[:-1] # Active : Every datagram holds one or more complete results
+		for line in lines:
+			for ss in self._search.keys(): # Results are matched against every search that hasnt expired
+				self.search_result_forward(ss,line,True)
 		return args
 	def search_result_forward(self,pattern,data,validate):
 		try: ss = re.findall("^([TF])\?([TF])\?([0-9]*)\?([0-9])\?(.*)$",pattern)[0]
@@ -931,8 +1262,11 @@ class pydc_client():
 			name = result[1].lower()
 			size = int(ss[2])
 			type = int(ss[3])
-			for word in self.unescape(ss[4].replace("$"," ")).lower().split():
-				if name.count(word)==0: return 1 # All words should be present
+			if type==9: # TTH Search : The result should be the file itself, whatever its name
+				if len(result)!=6 or result[5].upper()!=ss[4].upper(): return 6 # TTH mismatch
+			else:
+				for word in self.unescape(ss[4].replace("$"," ")).lower().split():
+					if name.count(word)==0: return 1 # All words should be present
 			if len(result)==6:
 				filesize = int(result[2]);
 				if ss[0]=="T": # Size limit
@@ -943,17 +1277,17 @@ class pydc_client():
 					for extn in self._fileextn[type].split():
 						if name.endswith("."+extn): match=True # Check extension
 					if not match: return 4 # Extension mismatch
-				elif type==9:
-					result[5]
 			if len(result)==5:
 				if type in [2,3,4,5,6,7,9]: return 5 # File Types only
+		search = self._search.get(pattern)
+		if search is None: return 7 # Expired
 		if len(result)==6: # File Result
 			result[3] = int(result[3]); result[4] = int(result[4])
-			try: self._search[pattern]["result"](["File"]+result)
+			try: search["result"](["File"]+result)
 			except: self._mainchat("Search Result for \"%s\" from %s: %s (FileSize: %s) %s (Slots: %d/%d)\n" % (ss[4],result[0],result[1],self.filesize(result[2]),result[5].replace("TTH:","TTH: "),result[3],result[4]))
 		if len(result)==5: # Directory Result
 			result[2] = int(result[2]); result[3] = int(result[3])
-			try: self._search[pattern]["result"](["Folder"]+result)
+			try: search["result"](["Folder"]+result)
 			except: self._mainchat("Search Result for \"%s\" from %s: %s (Directory) %s (Slots: %d/%d)\n" % (ss[4],result[0],result[1],result[4],result[2],result[3]))
 		return 0 # Success
 
@@ -964,7 +1298,6 @@ class pydc_client():
 			self._groups[group] = []
 			self.debug("Successfully created new group : "+group)
 			self._filelist[group] = []
-			self._shared[group] = None
 		else: self.debug("A group by this name already exists : "+group)
 		return self
 	def group_add(self,group,nick): # Add a nick to the specified group, removing it from all others
@@ -990,26 +1323,31 @@ class pydc_client():
 		for name in self._groups:
 			if nick in self._groups[name]: return name
 		return self._config["group_base"]
+	def group_mask(self,group): # Returns the bit identifying the specified group in the visibility masks of the share, assigning an unused one if required.
+		if group not in self._groupbits:
+			bit = 1
+			while bit in self._groupbits.values(): bit <<= 1
+			self._groupbits[group] = bit
+		return self._groupbits[group]
 	def group_rename(self,group,newname): # Renames a group, by deleting the old one, and creating a new one.
 		if group not in self._groups:
 			self.debug("A group by this name does not exist : "+group)
 		elif newname in self._groups:
 			self.debug("A group by this name already exists : "+newname)
 		else:
-			self._group[newname] = self._group[group]
+			self._groups[newname] = self._groups[group]
 			self._filelist[newname] = self._filelist[group]
-			self._shared[newname] = self._shared[group]
+			self._groupbits[newname] = self.group_mask(group) # The share stays visible to the group under its new name
 			self._groups.pop(group,None)
 			self._filelist.pop(group,None)
-			self._shared.pop(group,None)
+			self._groupbits.pop(group,None)
 		return self
 	def group_delete(self,group): # Delete a group, causing all its memebers to fall back to the default group.
 		if group==self._config["group_base"]:
 			self.debug("This group is the default one and cannot be deleted : "+group)
 		else:
 			self._groups.pop(group,None)
-			self._filelist.pop(group,None)
-			self._shared.pop(group,None)
+			self._filelist.pop(group,None) # Whatever was shared only with this group is removed from the share with the next refresh
 			self.debug("Successfully deleted group : "+group)
 		return self
 
@@ -1031,97 +1369,378 @@ class pydc_client():
 			self.debug("Directory/File successfully removed from the filelist of group :"+group)
 		except: pass
 		return self
-	def filelist_generate(self,group=None): # Based on current entires, generate a filelist belonging to specified group.
+	def filelist_generate(self,group=None,wait=False): # Based on current entires, generate the filelist belonging to specified group, or to each of a list of groups. New files are hashed in the background and published as they are done, unless wait is True.
+		# Paths shared with several groups are scanned only once, as all groups share the same share.ShareTree.
 		if group is None: group = self._config["group_base"]
-		self.debug("Attempting to generate filelist for group : "+group)
-		if group not in self._filelist:
-			self.debug("Invalid group specified for which filelist is to be generated.")
-			return self
-		if group not in self._shared or len(self._shared[group].getElementsByTagName("FileListing"))==0:
-			self._shared[group] = xml.dom.minidom.Document()
-			fl = self._shared[group].createElement("FileListing") # <FileListing Version="1" CID="_____" Base="/" Generator="_____">
-			fl.setAttribute("Version","1"); fl.setAttribute("CID",self._config["cid"]); fl.setAttribute("Base","/"); fl.setAttribute("Generator",self._config["signature"])
-		elif len(self._shared[group].getElementsByTagName("FileListing"))>0:
-			fl = self._shared[group].getElementsByTagName("FileListing")[0]
-		else: return # NOTICE : Error
-		list = sorted(self._filelist[group])
-		for item in list:
-			self.filelist_generate_recursive(self._shared[group],fl,item)
-		self._shared[group].appendChild(fl)
-		target = self._dir["filelist"]+os.sep+"#"+self.escape_filename(group,True)+".xml"
-		print >>open(target,"w"), self._shared[group].toprettyxml(indent="\t").replace('<?xml version="1.0" ?>','<?xml version="1.0" encoding="utf-8" standalone="yes"?>')
-		self.debug("Successfully generated filelist for group : "+group)
-		self.bz2_compress(target)
+		groups = group if type(group) is list else [group]
+		for group in groups:
+			self.debug("Attempting to generate filelist for group : "+group)
+			if group not in self._filelist: self.debug("Invalid group specified for which filelist is to be generated.")
+		groups = [group for group in groups if group in self._filelist]
+		if len(groups)==0: return self
+		self._sharelock.acquire()
+		try:
+			tree = self._share
+			masks = self.filelist_masks()
+			changed = self.filelist_prune(masks)
+			pending = [] # Files that still need a TTH, as (directory entry, share.Record) pairs
+			for item in sorted(set([share.normalize(item) for group in groups for item in self._filelist[group]])):
+				source = tree.share(item,masks[item])
+				self._snapshot[source] = {}
+				self.filelist_generate_walk(tree,source,item,pending,self._snapshot[source])
+				changed |= masks[item] # Every group sharing this path sees the result of the scan
+			if wait: # The walk only enumerates files; they are all hashed together here
+				hashes = self.tth_batch([record for parent,record in pending])
+				for parent,record in pending:
+					if hashes.get(record.path) is None: continue # Files that could not be read are left out, as they were before
+					tree.add(parent,os.path.basename(record.path),record.size,hashes[record.path],record.mtime)
+			else: self.hash_enqueue([(tree,parent,record) for parent,record in pending])
+			self.filelist_write(sorted(set(groups+self.filelist_groups(changed)))) # Publish whatever has been hashed already
+		finally: self._sharelock.release()
+		return self
+	def filelist_key(self): # Returns a string identifying the shared paths of all groups, saved with snapshots of the share, so that snapshots taken before they were changed are not used
+		return repr(sorted([(group,sorted(set([share.normalize(item) for item in self._filelist[group]]))) for group in self._filelist]))
+	def filelist_masks(self): # Returns a dict mapping every shared path (without a trailing separator) to the bitmask of the groups it is shared with
+		result = {}
+		for group in self._filelist:
+			for item in self._filelist[group]: result[share.normalize(item)] = result.get(share.normalize(item),0)|self.group_mask(group)
+		return result
+	def filelist_groups(self,mask): # Returns the groups in a bitmask
+		return [group for group in self._filelist if self.group_mask(group)&mask]
+	def filelist_prune(self,masks): # Removes the paths that are no longer shared with any group from the share, and updates the groups the others are shared with, as given by filelist_masks; returns the bitmask of the groups whose filelists have changed as a result
+		tree = self._share
+		changed = 0
+		sources = dict([(tree.find(tree.ROOT,item),item) for item in masks])
+		for source in tree.sources(current=True):
+			if source not in sources: # No longer shared
+				changed |= tree.mask(source)
+				tree.remove(source); self._snapshot.pop(source,None)
+			elif tree.mask(source)!=masks[sources[source]]:
+				changed |= tree.mask(source)^masks[sources[source]]
+				tree.share(sources[source],masks[sources[source]])
+		return changed
+	def filelist_write(self,groups=None): # Commits the changes made to the share, and writes a snapshot of it to disk along with the filelists of the specified groups (all of them, if omitted), in bz2 compressed form.
+		self._sharelock.acquire()
+		try:
+			tree = self._share
+			tree.commit()
+			self._hasher["lock"].acquire()
+			try: queue = [(parent,tuple(record)) for item,parent,record in itertools.chain(self._hasher["chunk"],self._hasher["queue"]) if item is tree] # Files yet to be added to the share
+			finally: self._hasher["lock"].release()
+			target = self._dir["settings"]+os.sep+self._config["share_snapshot"]
+			tree.save(target+".tmp",self.filelist_key(),(self._groupbits,self._snapshot,queue))
+			self.file_replace(target+".tmp",target)
+			for group in (groups if groups is not None else self._filelist.keys()):
+				target = self._dir["filelist"]+os.sep+"#"+self.escape_filename(group,True)+".xml.bz2"
+				self.bz2_write(target,tree.xml(self._config["cid"],self._config["signature"],self.group_mask(group)))
+				if os.path.isfile(target[:-4]): os.remove(target[:-4]) # Plain filelists written by earlier versions
+				self.debug("Successfully generated filelist for group : "+group)
+		finally: self._sharelock.release()
+		return self
+	def filelist_generate_walk(self,tree,root,item,pending,snapshot): # Used by the filelist_generate method to add a shared directory or file, and everything within it, to the share; returns True if the share was modified
+		# "tree" is the share.ShareTree, "root" is the directory entry (or source) to which the item belongs, "item" is the path of the shared directory or file, "pending" is the list to which new files are added, "snapshot" is the dict in which the state of directories is recorded
+		# New files are only added to their directory once they have been hashed, so that a filelist never contains files without a TTH
+		item = share.normalize(item)
+		directories = { os.path.dirname(item):root } # Path -> entry, for every directory seen so far
+		modified = False
+		for record in share.walk(item): # Parents are always seen before their contents
+			parent = directories[os.path.dirname(record.path)]
+			if record.size is None: # <Directory Name="_____">
+				entry = tree.find(parent,os.path.basename(record.path))
+				if entry is None or not tree.directory(entry): # Add this directory again only if it hasent been added yet.
+					entry = tree.add(parent,os.path.basename(record.path))
+					modified = True
+				directories[record.path] = entry
+				snapshot[record.path] = (record.mtime,entry)
+			else: modified = self.filelist_generate_file(tree,parent,record,pending) or modified
+		# Files/directories that were accessible once, but not now, are left in the filelist. This will allow external harddisks to be disconnected and reconnected without the problem of rehashing.
+		return modified
+	def filelist_generate_file(self,tree,parent,record,pending,since=None): # Adds a file found while scanning to the share, unless it is already there and unchanged; returns True if an outdated entry was removed
+		# "since" is the modification time of the directory when it was last scanned, if it has been scanned before
+		entry = tree.find(parent,os.path.basename(record.path))
+		modified = entry is not None
+		if entry is not None and not tree.directory(entry):
+			tth = self._hashes.get(record.device,record.inode,record.size,record.mtime)
+			if tth is not None and tth==tree.tth(entry): return False # Hashed, and not modified since
+			if tth is None and (record.device,record.inode) not in self._hashes and (since is None or record.mtime<=since) and tree.size(entry)==record.size: return False # Not in the hash cache : If the name and the size of the file havent changed (and it wasnt replaced since the last scan), assume that it has already been hashed.
+			tree.remove(entry) # <File Name="_____" Size="_____" TTH="_____"/> : Replaced once the new contents have been hashed
+		pending.append((parent,record)) # The TTH is filled in by filelist_generate or the background hasher
+		return modified
+	def filelist_refresh(self,group=None): # Update the filelist belonging to specified group (all groups, if omitted), rescanning only the directories that have changed since they were last scanned.
+		# Directories are compared against the snapshot taken when they were last scanned: a changed modification time or a removed directory causes the directory to be listed again. Files modified in place (rather than replaced) within an unchanged directory are only noticed by filelist_generate.
+		# New and changed files are hashed in the background, which publishes them; filelists are rewritten here only if something else has changed. Paths shared with several groups are scanned once, and the filelists of all those groups are updated.
+		groups = [group] if group is not None else self._filelist.keys()
+		groups = [group for group in groups if group in self._filelist]
+		self._sharelock.acquire()
+		try:
+			tree = self._share
+			masks = self.filelist_masks()
+			changed = self.filelist_prune(masks) # Groups whose filelists need to be written
+			pending = [] # Files that still need a TTH, as (directory entry, share.Record) pairs
+			for item in sorted(set([share.normalize(item) for group in groups for item in self._filelist[group]])):
+				source = tree.share(item,masks[item])
+				snapshot = self._snapshot.setdefault(source,{})
+				if item not in snapshot: # Newly shared, never scanned, or directly shared files
+					if self.filelist_generate_walk(tree,source,item,pending,snapshot): changed |= masks[item]
+					continue
+				if not os.path.isdir(item): continue # Shared directories that are inaccessible (eg: disconnected disks) are left as they are, along with everything within them
+				for path in sorted(snapshot): # Parents before their contents
+					if path not in snapshot: continue # Removed along with a parent
+					mtime,entry = snapshot[path]
+					record = share.record(path)
+					if record is None or record.size is not None: # Removed, but its parent has not changed (eg: a disk mounted within the share)
+						self.filelist_forget(snapshot,path)
+						if tree.alive(entry): tree.remove(entry); changed |= masks[item]
+						continue
+					if record.mtime==mtime: continue # Unchanged
+					if self.filelist_refresh_directory(tree,entry,record,pending,snapshot): changed |= masks[item]
+			self.hash_enqueue([(tree,parent,record) for parent,record in pending])
+			if changed or len(pending)>0: self.filelist_write(self.filelist_groups(changed)) # The snapshot is saved along with the queue of files to be hashed
+		finally: self._sharelock.release()
+		for group in groups: self.debug("Successfully refreshed filelist for group : "+group+(" (unchanged)" if not self.group_mask(group)&changed and len(pending)==0 else ""))
+		return self
+	def filelist_refresh_directory(self,tree,directory,record,pending,snapshot): # Used by filelist_refresh to list a changed directory (given as its entry and Record) again, adding new entries and removing those that no longer exist; returns True if the share was modified
+		seen = {} # Names that were found
+		modified = False
+		try: entries = share.listdir(record.path)
+		except OSError: return modified # Nothing is removed based on an incomplete listing; it will be retried the next time, as the snapshot is not updated
+		since = snapshot[record.path][0] if record.path in snapshot else None
+		snapshot[record.path] = (record.mtime,directory)
+		for name,item in entries:
+			seen[name] = True
+			if item.size is None:
+				entry = tree.find(directory,name)
+				if entry is None or not tree.directory(entry) or item.path not in snapshot: # New directories are scanned completely
+					modified = self.filelist_generate_walk(tree,directory,item.path,pending,snapshot) or modified
+			else: modified = self.filelist_generate_file(tree,directory,item,pending,since) or modified
+		for entry in tree.children(directory,True):
+			if tree.name(entry) in seen: continue
+			tree.remove(entry); modified = True
+			if tree.directory(entry): self.filelist_forget(snapshot,record.path+os.sep+tree.name(entry))
+		return modified
+	def filelist_forget(self,snapshot,path): # Removes a directory and everything within it from a snapshot
+		for item in [item for item in snapshot if item==path or item.startswith(path+os.sep)]: del snapshot[item]
+	def hash_stale(self,entries): # Takes (entry, share.Record or None) pairs for files in the share that no longer match what was hashed, removes them, and queues those that still exist to be hashed again; they are published by the hasher as usual
+		pending = []; changed = 0
+		self._sharelock.acquire()
+		try:
+			tree = self._share
+			for entry,record in entries:
+				if not tree.alive(entry): continue # Already dealt with, eg: by a refresh
+				changed |= tree.mask(entry)
+				tree.remove(entry)
+				if record is not None and record.size is not None: pending.append((tree,tree.parent(entry),record))
+				self.debug("Hashing changed file again : "+(record.path if record is not None else tree.name(entry)))
+			self.hash_enqueue(pending)
+			if changed and len(pending)==0: self.filelist_write(self.filelist_groups(changed)) # Nothing will be published by the hasher
+		finally: self._sharelock.release()
+		return self
+	def hash_enqueue(self,entries): # Queues (share.ShareTree, directory entry, share.Record) entries for the background hasher
+		self._hasher["lock"].acquire()
+		try:
+			for tree,parent,record in entries:
+				if record.path in self._hasher["queued"]: continue # Already waiting, from an earlier call
+				self._hasher["queue"].append((tree,parent,record))
+				self._hasher["queued"].add(record.path)
+				self._hasher["queued_bytes"] += record.size
+		finally: self._hasher["lock"].release()
+		return self.hash_start()
+	def hash_start(self): # Starts the background hasher, if there are files to be hashed and it isnt running already
+		self._hasher["lock"].acquire()
+		try:
+			if len(self._hasher["queue"])>0 and self._hasher["thread"] is None:
+				self._hasher["active"] = True
+				self._hasher["start"] = time.time(); self._hasher["budget"] = 0
+				self._hasher["thread"] = self.spawn("Hasher",self.hash_manager)
+		finally: self._hasher["lock"].release()
+		return self
+	def hash_stop(self): # Stops the background hasher once it has finished the current chunk; the remaining files stay queued
+		self._hasher["active"] = False
+		thread = self._hasher["thread"]
+		if thread is not None and thread is not threading.current_thread(): thread.join()
+		self._hasher["thread"] = None
+		return self
+	def hash_pause(self): # Stops reading files until hash_resume() is called
+		self._hasher["running"].clear()
+		self.debug("Hashing paused.")
+		return self
+	def hash_resume(self): # Continues hashing after hash_pause()
+		self._hasher["start"] = time.time(); self._hasher["budget"] = 0 # Time spent paused does not count towards the read rate
+		self._hasher["running"].set()
+		self.debug("Hashing resumed.")
+		return self
+	def hash_progress(self): # Returns the status of the background hasher
+		elapsed = time.time()-self._hasher["start"]
+		return {"files":self._hasher["files"], "bytes":self._hasher["bytes"], "queue":len(self._hasher["queue"]), "queued_bytes":self._hasher["queued_bytes"], "rate":(self._hasher["budget"]/elapsed if elapsed>0 else 0.0), "paused":not self._hasher["running"].is_set(), "active":self._hasher["thread"] is not None}
+	def hash_throttle(self,size): # Called after size bytes have been read by the hasher; waits while hashing is paused, and for as long as it takes to stay within hash_rate
+		while self._hasher["active"] and not self._hasher["running"].is_set(): self._hasher["running"].wait(1)
+		self._hasher["bytes"] += size
+		self._hasher["budget"] += size
+		if self._config["hash_rate"]>0:
+			delay = float(self._hasher["budget"])/(self._config["hash_rate"]*1024*1024)-(time.time()-self._hasher["start"])
+			if delay>0: time.sleep(delay)
+	def hash_manager(self): # A loop that hashes queued files in chunks, adding them to their shares as they are done, and periodically committing and writing the filelists that have changed.
+		changed = 0 # Bitmask of the groups whose filelists have changed since they were last written
+		published = time.time()
+		while self._hasher["active"]:
+			if not self._hasher["running"].is_set(): # Paused
+				self._hasher["running"].wait(1); continue
+			limit = self._config["hash_rate"]*1024*1024 if self._config["hash_rate"]>0 else self._config["hash_chunk"] # About a second worth of reads, if the rate is limited
+			chunk = []; total = 0
+			self._hasher["lock"].acquire()
+			while len(self._hasher["queue"])>0 and (len(chunk)==0 or total+self._hasher["queue"][0][2].size<=limit):
+				chunk.append(self._hasher["queue"].popleft()); total += chunk[-1][2].size
+			if len(chunk)==0: self._hasher["thread"] = None # Nothing left to do; hash_enqueue starts a new thread when required
+			self._hasher["chunk"] = chunk
+			self._hasher["lock"].release()
+			if len(chunk)==0: break
+			hashes = self.tth_batch([entry[2] for entry in chunk],self.hash_throttle)
+			self._sharelock.acquire()
+			try:
+				for tree,parent,record in chunk:
+					if hashes.get(record.path) is None or self._share is not tree or not tree.alive(parent): continue # Unreadable, or the directory has been removed since
+					tree.add(parent,os.path.basename(record.path),record.size,hashes[record.path],record.mtime)
+					changed |= tree.mask(parent)
+			finally: self._sharelock.release()
+			self._hasher["lock"].acquire()
+			self._hasher["chunk"] = []
+			for tree,parent,record in chunk:
+				self._hasher["queued"].discard(record.path)
+				self._hasher["queued_bytes"] -= record.size
+				self._hasher["files"] += 1
+			self._hasher["lock"].release()
+			if time.time()-published>=self._config["hash_publish"]:
+				if changed: self.filelist_write(self.filelist_groups(changed))
+				changed = 0; published = time.time()
+		if changed: self.filelist_write(self.filelist_groups(changed))
+		self.debug("Hashing completed." if len(self._hasher["queue"])==0 else "Hashing stopped.")
 		return self
-	def filelist_generate_recursive(self,base,current,item): # Used by the filelist_generate method due to unknown recursion lengths.
-		# "base" is the xml.dom.minidom.Document() object from which all elemnts are to be created, "current" is the name of the directory that contains the current item, "item" is the path and name of the current item
-		if os.path.isdir(item): # <Directory Name="_____">
-			if item[-1]==os.sep: item=item[:-1]
-			dirname = item.split(os.sep)[-1]
-			dirs = filter( lambda x: x.getAttribute("Name")==dirname , current.getElementsByTagName("Directory") )
-			if len(dirs)==0: # Add this directory again only if it hasent been added yet.
-				dir = base.createElement("Directory")
-				dir.setAttribute("Name",dirname)
-				current.appendChild(dir)
-			else: dir = dirs[0]
-			list = sorted(os.listdir(item)) # Separate object is created to ensure that it doesnt change during the following loop
-			for file in list: self.filelist_generate_recursive(base,dir,item+os.sep+file)
-		elif os.path.isfile(item): # <File Name="_____" Size="_____" TTH="_____"/>
-			filename = item.split(os.sep)[-1]
-			try: filesize = str(os.path.getsize(item))
-			except: filesize = 0
-			# If the name and the size of the file havent changed, assume that it has already been hashed.
-			if len(filter( lambda x: x.getAttribute("Name")==filename and x.getAttribute("Size")==filesize , current.getElementsByTagName("File") ))==0:
-				f = base.createElement("File")
-				f.setAttribute("Name",filename)
-				f.setAttribute("Size",filesize)
-				f.setAttribute("TTH", self.tth_generate(item) )
-				current.appendChild(f)
-		else: return # Ignore files/directories that were accessible once, but not now. This will allow external harddisks to be disconnected and reconnected without the problem of rehashing.
-	def filelist_refresh(self,group=None): pass # INCOMPLETE : Update the filelist belonging to specified group.
 	def tiger_hash(self,data): # Generates the Tiger Hash for a given string
-		result = tiger.hash(data) # From the aformentioned tiger-hash-python script, 48-char hex digest
-		result = "".join([ "".join(self.str_divide(result[i:i+16],2)[::-1]) for i in range(0,48,16) ]) # Representation Transform
-		result = "".join([chr(int(c,16)) for c in self.str_divide(result,2)]) # Converting every 2 hex characters into 1 normal
+		return tiger.Tiger(data).digest() # Raw 24 byte digest, in the byte order used by the Tiger Tree Hash
+	def tth_batch(self,records,throttle=None): # Takes a list of share.Record objects and returns a dict mapping their paths to Tiger Tree Hashes; files not in the hash cache are hashed across worker processes, in batches of similar total size
+		result = {}
+		missing = {} # Records of files not in the cache; they are obtained before files are hashed, so that changes made while hashing are noticed the next time
+		small = [] # (path, size) pairs for files to be hashed whole by a worker
+		large = [] # Files hashed one at a time, each split across all workers by tth_generate
+		for record in records:
+			tth = self._hashes.get(record.device,record.inode,record.size,record.mtime)
+			if tth is not None and tth in self._trees: # The stored tree is needed for TTHL requests too
+				result[record.path] = tth; continue
+			missing[record.path] = record
+			if record.size>=self._config["hash_parallel"]: large.append(record.path)
+			else: small.append((record.path,record.size))
+		processes = self._config["hash_processes"] if self._config["hash_processes"]>0 else multiprocessing.cpu_count()
+		pool = None
+		if processes>1 and len(small)>1:
+			try: pool = multiprocessing.Pool(min(processes,len(small)))
+			except (EnvironmentError,ImportError), e: self.debug("Could not start hashing processes, hashing serially : "+str(e)) # eg: No /dev/shm
+		if pool is not None:
+			try:
+				for batch in pool.imap_unordered(tigertree._hash_files,[(paths,self._config["hash_lanes"],self._config["hash_buffer"],self._config["tthl_depth"]) for paths in tigertree.batches(small,processes*4)]):
+					for file,tth,length,level,nodes in batch:
+						if tth is None: continue
+						self._trees.put(tth,length,level,nodes)
+						result[file] = tth
+					if throttle is not None: throttle(sum([item[2] for item in batch]))
+			finally:
+				pool.close(); pool.join()
+		else: large = [file for file,size in small]+large
+		for file in large: result[file] = self.tth_generate(file,throttle)
+		for file in missing:
+			record = missing[file]
+			if result.get(file) is not None: self._hashes.put(record.device,record.inode,record.size,record.mtime,result[file])
 		return result
-	def tth_generate(self,file): # Generates the Tiger Tree Hash (Merkle Tree) for a given file
+	def tth_generate(self,file,throttle=None): # Generates the Tiger Tree Hash (Merkle Tree) for a given file, and stores the tree for TTHL requests; throttle, if given, is called with the number of bytes after every read
 		# During the hashing of the raw data from the file, the leaf hash function uses the marker 0x00 prepended to the data before tiger hashing it. Similarly, the marker 0x01 is prepended in case of internal nodes.
-		blocksize = 1024 # Standard Block Size
-		filesize = os.path.getsize(file) # Get filesize for subsequent calculations
-		if filesize==0: return [[self.tiger_hash(chr(0))]] # On failure of getsize or if file is empty, return hash for empty file.
 		try: handle = open(file,"rb") # Open file for reading in binary mode
 		except: return None # If it doesnt exist or is inaccessible, dont bother.
-		level = [[]] # List of Levels, Level 0 Empty
-		for i in range(int(math.ceil(float(filesize)/blocksize))):
-			block = handle.read(blocksize) # Read part of the file
-			level[0].append(self.tiger_hash(chr(0)+block)) # Hash that part only, and put it in Level 0
-		handle.close() # Close file
-		current = 0 # Starting from level 0
-		while len(level[0])>1: # If whole file hasent been hashed yet
-			level.append([]) # Create new level
-			for i in range(len(level[current])/2): # For all hash pairs
-				level[1].append( self.tiger_hash(chr(1)+level[0][2*i]+level[0][2*i+1]) ) # Combine two hashes to get a binary tree like structure.
-			if len(level[0])%2==1: level[1].append(level[0][-1]) # If last item cannot be paired, promote it untouched.
-			del level[0] # Discard lower level hashes, as they are no longer necessary
-		return base64.b32encode(level[0][0])[:-1] # Result will be 40 characters; discarding the trailing '=' makes it 39
-	def bz2_compress(self,file,type=True): # Compress/Decompress files into/from the bz2 format. compress if type else decompess
+		filesize = os.path.getsize(file)
+		level = tigertree.level(filesize,self._config["tthl_depth"]) # The level of the tree that is to be stored
+		tree = None
+		if self._config["hash_processes"]!=1 and filesize>=self._config["hash_parallel"] and (throttle is None or self._config["hash_rate"]==0): # Large files are split into subtrees hashed by worker processes, unless reads need to be paced
+			handle.close()
+			try:
+				tree = tigertree.parallel(file,self._config["hash_processes"],self._config["hash_lanes"],self._config["hash_buffer"],level=level)
+				if throttle is not None: throttle(filesize)
+			except (EnvironmentError,mmap.error), e:
+				self.debug("Parallel hashing failed, hashing serially : "+file+" : "+str(e))
+				handle = open(file,"rb")
+		if tree is None:
+			tree = tigertree.TigerTree(lanes=self._config["hash_lanes"],level=level) # Leaves are folded into the tree as they are read, so only O(log n) hashes are kept in memory.
+			while True:
+				data = handle.read(self._config["hash_buffer"]) # Read large chunks to minimize the number of system calls
+				if data=="": break # End of file
+				tree.update(data)
+				if throttle is not None: throttle(len(data))
+			handle.close() # Close file
+		tth = tree.base32() # Result will be 40 characters; discarding the trailing '=' makes it 39
+		self._trees.put(tth,tree.length(),level,tree.nodes()) # Save the tree, so that peers can verify segments without the file being hashed again
+		return tth
+	def file_replace(self,source,target): # Renames a file over another one, which is done atomically except on Windows, where the target has to be removed first
+		try: os.rename(source,target)
+		except OSError:
+			if not os.path.isfile(target): raise
+			os.remove(target); os.rename(source,target)
+		return self
+	def bz2_write(self,target,data): # Compresses the strings yielded by data into a file, through a temporary file which then replaces the target, so that readers never see a partially written file
+		handle = open(target+".tmp","wb")
+		try: self.bz2_stream(self.bz2_blocks(data),handle)
+		finally: handle.close()
+		return self.file_replace(target+".tmp",target)
+	def bz2_blocks(self,data): # Joins the strings yielded by data into blocks of bz2_block bytes (the last one may be shorter), yielding at least one block
+		size = self._config["bz2_block"]
+		buffer = []; length = 0; count = 0
+		for item in data:
+			buffer.append(item); length += len(item)
+			if length>=size:
+				buffer = "".join(buffer)
+				for i in range(0,len(buffer)-size+1,size):
+					yield buffer[i:i+size]; count += 1
+				buffer = [buffer[len(buffer)-len(buffer)%size:]]; length = len(buffer[0])
+		if length>0 or count==0: yield "".join(buffer)
+	def bz2_stream(self,blocks,handle): # Compresses blocks of data into an open file. Small amounts of data are compressed serially into a single bz2 stream; anything larger is compressed one block at a time by worker processes, whose streams are written one after the other, as a multi-stream bz2 file.
+		blocks = iter(blocks)
+		first = [] # Blocks read before deciding whether to compress them in parallel
+		for block in blocks:
+			first.append(block)
+			if len(first)*self._config["bz2_block"]>=self._config["bz2_parallel"]: break
+		processes = self._config["bz2_processes"] if self._config["bz2_processes"]>0 else multiprocessing.cpu_count()
+		pool = None
+		if processes>1 and len(first)*self._config["bz2_block"]>=self._config["bz2_parallel"]:
+			try: pool = multiprocessing.Pool(processes)
+			except (EnvironmentError,ImportError), e: self.debug("Could not start compression processes, compressing serially : "+str(e)) # eg: No /dev/shm
+		if pool is None:
+			compressor = bz2.BZ2Compressor()
+			for block in itertools.chain(first,blocks): handle.write(compressor.compress(block))
+			handle.write(compressor.flush())
+			return self
+		try:
+			pending = collections.deque() # Blocks being compressed, in order; at most two per process, so that memory use does not depend on the amount of data
+			for block in itertools.chain(first,blocks):
+				if len(pending)>=processes*2: handle.write(pending.popleft().get())
+				pending.append(pool.apply_async(share.compress,(block,)))
+			while len(pending)>0: handle.write(pending.popleft().get())
+		finally:
+			pool.close(); pool.join()
+		return self
+	def bz2_compress(self,file,type=True): # Compress/Decompress files into/from the bz2 format. compress if type else decompess. Files made up of several bz2 streams (such as those compressed in parallel) are decompressed whole.
 		if not os.path.exists(file) or os.path.isdir(file): return False
-		try: filesize = os.path.getsize(file)
-		except: return False
 		if not type and not file.endswith(".bz2"): return False
-		blocksize = 102400
-		if type: compressor = bz2.BZ2Compressor()
-		else: decompressor = bz2.BZ2Decompressor()
-		handle1 = open(file,"rb")
+		blocksize = self._config["bz2_block"]
+		try: handle1 = open(file,"rb") if type else share.BZ2Reader(open(file,"rb"))
+		except EnvironmentError: return False
 		handle2 = open(file+".bz2","wb") if type else open(file[:-4],"wb")
-		for i in range(int(math.ceil(float(filesize)/blocksize))):
-			if type: handle2.write(compressor.compress(handle1.read(blocksize)))
-			else: handle2.write(decompressor.decompress(handle1.read(blocksize)))
-		if type: handle2.write(compressor.flush())
-		handle1.close(); handle2.close()
+		try:
+			if type: self.bz2_stream(iter(lambda: handle1.read(blocksize),""),handle2)
+			else:
+				for data in iter(lambda: handle1.read(blocksize),""): handle2.write(data)
+		except (EnvironmentError,EOFError), e:
+			self.debug("Could not "+("" if type else "de")+"compress file : "+file+" : "+str(e))
+			return False
+		finally: handle1.close(); handle2.close()
 		self.debug("Successfully "+("" if type else "de")+"compressed file : "+file)
 		return True
-		
+
 	################################################## Client Behaviour Functions ##################################################
 
 	def cli(self): # Provide a Command Line Interface for testing purposes before the GUI can be built
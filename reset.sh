@@ -3,3 +3,4 @@ rm -rf Downloads
 rm -rf Filelists
 rm -rf Incomplete
 rm -rf Settings
+rm -rf Quarantine
@@ -0,0 +1,500 @@
+import array, base64, bz2, collections, itertools, marshal, os, re, stat, struct, sys, threading, zlib
+import tigertree
+
+try: import xml.etree.cElementTree as ElementTree
+except ImportError: import xml.etree.ElementTree as ElementTree
+
+try: scandir = os.scandir # Python 3.5+
+except AttributeError:
+	try: from scandir import scandir # The backport, if it is installed
+	except ImportError: scandir = None # Fall back to listdir() and one stat() per entry
+
+try: _intern = intern # Python 2
+except NameError: _intern = sys.intern
+
+try: SIZE = array.array("Q").typecode # Unsigned 64 bit integers, where available (Python 3.3+)
+except ValueError: SIZE = "L" if array.array("L").itemsize==8 else "d" # Doubles represent sizes up to 8PB exactly
+
+# Characters separating the tokens of names in the search index : ASCII characters other than letters and digits (bytes of UTF-8 encoded characters are part of tokens)
+SEPARATORS = re.compile("[\\x00-\\x2f\\x3a-\\x40\\x5b-\\x60\\x7b-\\x7f]+")
+
+MATCHES = 10000 # Maximum number of search terms whose matching tokens are remembered, for files and for directories each
+INTERSECT = 8 # The entries matching a part of a search term are only collected into a set if there are at most this many times as many as for the most selective part
+
+def tokens(name): # Returns the distinct tokens of a name (or search term), in lowercase
+	return set([token for token in SEPARATORS.split(name.lower()) if token!=""])
+
+# A file or directory found while walking the share: path, size in bytes (None for directories), modification time in nanoseconds, inode and device.
+Record = collections.namedtuple("Record","path size mtime inode device")
+
+def record(path): # Returns the Record of a single file or directory, or None if it is inaccessible or something else. Symbolic links are followed, as they are while walking.
+	try: info = os.stat(path)
+	except OSError: return None
+	if not stat.S_ISDIR(info.st_mode) and not stat.S_ISREG(info.st_mode): return None # Devices, sockets, pipes
+	return Record(path,(None if stat.S_ISDIR(info.st_mode) else info.st_size),tigertree.mtime(info),info.st_ino,info.st_dev)
+
+def listdir(path): # Returns the entries of a directory as (name, Record) pairs sorted by name, using the type and stat data that come with the directory listing where possible.
+	result = []
+	if scandir is not None:
+		iterator = scandir(path)
+		try:
+			for entry in iterator:
+				try:
+					info = entry.stat() # Cached by the entry on Windows; a single stat() (following links) elsewhere
+					directory = stat.S_ISDIR(info.st_mode)
+					if not directory and not stat.S_ISREG(info.st_mode): continue # Devices, sockets, pipes
+					result.append((entry.name,Record(entry.path,(None if directory else info.st_size),tigertree.mtime(info),(info.st_ino or entry.inode()),info.st_dev)))
+				except OSError: continue # Broken links, or entries removed while walking
+		finally:
+			if hasattr(iterator,"close"): iterator.close()
+	else:
+		for name in os.listdir(path):
+			item = record(os.path.join(path,name))
+			if item is not None: result.append((name,item))
+	result.sort()
+	return result
+
+def normalize(path): # Removes the trailing separator from a path, unless it is the root directory
+	return path[:-1] if path!=os.sep and path.endswith(os.sep) else path
+
+def walk(path):
+	# Yields a Record for the given file or directory, followed by Records for everything within it (in the case of a directory), depth first, sorted by name within each directory.
+	# The walk is iterative, and makes a single stat() call per entry (none at all on Windows). Inaccessible entries are skipped, as are directories that have already been visited (eg: through symbolic links).
+	path = normalize(path)
+	top = record(path)
+	if top is None: return
+	yield top
+	if top.size is not None: return
+	visited = set([(top.device,top.inode)])
+	stack = [path] # Directories yet to be listed, the next one at the end
+	while len(stack)>0:
+		current = stack.pop()
+		try: entries = listdir(current)
+		except OSError: continue # Permission denied, or removed while walking
+		directories = []
+		for name,item in entries:
+			if item.size is None:
+				if item.inode!=0 and (item.device,item.inode) in visited: continue # Loop
+				visited.add((item.device,item.inode))
+				directories.append(item.path)
+			yield item
+		stack.extend(reversed(directories))
+
+class ShareTree:
+	"""
+	A compact representation of the files and directories shared with all groups, used instead of a DOM of the filelist of every group: entries are numbers, their properties are held in parallel arrays, and the contents of every directory are a slice of one ordering of all entries.
+	Changes are only seen by readers once commit() has merged them; removed entries are only marked as such, and their numbers are never reused.
+	Every shared path is a "source", a directory within the root named by the full path and carrying a bitmask of the groups it is shared with; the filelist of a group is the view of its sources (see view()).
+	Searches use an index of the committed entries, built by the first search and kept up to date by commit() (see search()).
+	"""
+	ROOT = 0 # The FileListing itself
+	DIRECTORY = 1
+	REMOVED = 2
+
+	def __init__(self):
+		self._name = [""] # Entry -> interned name
+		self._parent = array.array("i",[-1]) # Entry -> directory containing it
+		self._size = array.array(SIZE,[0]) # Entry -> size in bytes
+		self._mtime = array.array(SIZE,[0]) # Entry -> modification time of a file when it was hashed, in microseconds (exact even where SIZE is a double); 0 if unknown
+		self._tth = bytearray(24) # Entry -> root, at 24 bytes per entry
+		self._flags = bytearray([self.DIRECTORY]) # Entry -> DIRECTORY, REMOVED flags
+		self._lookup = {} # (directory, name) -> entry, for entries that have not been removed; None until it is first needed, for a tree restored from a snapshot
+		self._mask = {} # Source -> bitmask of the groups it is shared with
+		self._added = {} # Directory -> entries added to it since the last commit
+		self._changed = {} # Directories whose contents have changed since the last commit
+		self._view = (array.array("i"),array.array("i",[0]),array.array("i",[0])) # (ordering of all entries, entry -> start of its contents in the ordering, entry -> number of entries within it), replaced as a whole by commit()
+		self._tokens = None # Token -> files whose names contain it (array, sorted by size); None until the index is built by the first search
+		self._folders = {} # Token -> directories whose names contain it
+		self._extensions = {} # Extension -> files with it (array, sorted by size)
+		self._roots = {} # Root -> files with it
+		self._matches = ({},{}) # (files, directories) : Search term -> tokens containing it, extended as tokens are added
+		self._dead = 0 # Number of entries removed since the index was built
+		self._searching = threading.Lock() # Held while the index is searched or updated, as searches run without the lock of the share
+		self.version = 0 # Incremented by every commit that changed something
+		self.files = 0 # Number of files, as of the last commit
+		self.bytes = 0 # Total size of the files, as of the last commit
+
+	def add(self,parent,name,size=None,tth=None,mtime=None): # Adds a directory (if size is None) or a file (with the given root, base32, and modification time in nanoseconds, if known) to a directory, returning its number. An existing directory of the same name is returned as it is; any other existing entry is replaced.
+		if not isinstance(name,str): name = name.encode("utf-8") # Names are kept as UTF-8 encoded strings in Python 2
+		root = base64.b32decode(tth+"=") if tth is not None else "\0"*24
+		if len(root)!=24: raise ValueError("Invalid TTH : "+tth)
+		entry = self._index().get((parent,name))
+		if entry is not None:
+			if size is None and self._flags[entry]&self.DIRECTORY: return entry
+			self.remove(entry)
+		entry = len(self._name)
+		self._name.append(_intern(name))
+		self._parent.append(parent)
+		self._size.append(size or 0)
+		self._mtime.append((mtime or 0)//1000)
+		self._tth.extend(root)
+		self._flags.append(self.DIRECTORY if size is None else 0)
+		self._index()[(parent,self._name[entry])] = entry
+		self._added.setdefault(parent,[]).append(entry)
+		self._changed[parent] = True
+		return entry
+
+	def remove(self,entry): # Removes an entry, along with everything within it in case of a directory.
+		if entry==self.ROOT or self._flags[entry]&self.REMOVED: return self
+		self._changed[self._parent[entry]] = True
+		lookup = self._index()
+		stack = [entry]
+		while len(stack)>0:
+			item = stack.pop()
+			if self._flags[item]&self.REMOVED: continue
+			self._flags[item] |= self.REMOVED
+			self._dead += 1
+			if lookup.get((self._parent[item],self._name[item]))==item: del lookup[(self._parent[item],self._name[item])]
+			self._mask.pop(item,None)
+			if self._flags[item]&self.DIRECTORY: stack.extend(self.children(item,True))
+		return self
+
+	def _index(self): # Returns the (directory, name) -> entry dict, building it if required
+		if self._lookup is None:
+			flags = self._flags; REMOVED = self.REMOVED
+			self._lookup = dict([((self._parent[entry],self._name[entry]),entry) for entry in xrange(1,len(self._name)) if not flags[entry]&REMOVED])
+		return self._lookup
+
+	def share(self,path,mask): # Returns the source of a shared path, creating it if required, and makes it visible to the groups in the given bitmask
+		entry = self.add(self.ROOT,path)
+		if self._mask.get(entry)!=mask:
+			self._mask[entry] = mask
+			self._changed[self.ROOT] = True # Views change with the next commit
+		return entry
+
+	def sources(self,mask=None,current=False): # Returns the sources visible to any of the groups in a bitmask (all of them, if omitted), as of the last commit; or including uncommitted changes if current is True.
+		return [entry for entry in self.children(self.ROOT,current) if mask is None or self._mask.get(entry,0)&mask]
+
+	def mask(self,entry): # Returns the bitmask of the groups an entry is visible to
+		while entry!=self.ROOT and self._parent[entry]!=self.ROOT: entry = self._parent[entry]
+		return self._mask.get(entry,0) if entry!=self.ROOT else 0
+
+	def view(self,entries): # Returns the committed contents of a number of directories seen as one, as a list of (name, entries) pairs sorted by name. Directories of the same name are merged (entries lists all of them); of any other entries of the same name, the first one is seen.
+		if len(entries)==1: return [(self._name[item],[item]) for item in self.children(entries[0])]
+		merged = {}
+		for entry in entries:
+			for item in self.children(entry):
+				name = self._name[item]
+				if name not in merged: merged[name] = [item]
+				elif self._flags[item]&self.DIRECTORY and self._flags[merged[name][0]]&self.DIRECTORY: merged[name].append(item)
+		return sorted(merged.items())
+
+	def find(self,parent,name): # Returns the entry with the given name within a directory, or None.
+		if not isinstance(name,str): name = name.encode("utf-8")
+		return self._index().get((parent,name))
+
+	def children(self,entry,current=False): # Returns the entries within a directory, sorted by name, as of the last commit; or including uncommitted changes (unsorted) if current is True.
+		order,first,count = self._view
+		if entry>=len(first): result = [] # Added since the last commit
+		else: result = order[first[entry]:first[entry]+count[entry]].tolist()
+		if current: result = [item for item in result if not self._flags[item]&self.REMOVED]+[item for item in self._added.get(entry,[]) if not self._flags[item]&self.REMOVED]
+		return result
+
+	def commit(self): # Merges the changes made since the last commit into the ordering seen by readers; returns True if there were any.
+		if len(self._changed)==0: return False
+		order,first,count = self._view
+		neworder = array.array("i"); newfirst = array.array("i",[0])*len(self._name); newcount = array.array("i",[0])*len(self._name)
+		files = 0; total = 0
+		queue = collections.deque([self.ROOT])
+		while len(queue)>0: # Breadth first, so that the contents of every directory are contiguous
+			entry = queue.popleft()
+			if entry in self._changed: items = sorted(self.children(entry,True),key=self._name.__getitem__)
+			else: items = self.children(entry) # Unchanged
+			newfirst[entry] = len(neworder); newcount[entry] = len(items)
+			neworder.extend(items)
+			for item in items:
+				if self._flags[item]&self.DIRECTORY: queue.append(item)
+				else:
+					files += 1; total += int(self._size[item])
+		added = [item for items in self._added.values() for item in items if not self._flags[item]&self.REMOVED]
+		self._added = {}; self._changed = {}
+		self._view = (neworder,newfirst,newcount)
+		self._searching.acquire()
+		try:
+			if self._tokens is not None:
+				if self._dead>len(neworder): self._tokens = None # Rebuilt by the next search
+				else: self._insert(added)
+		finally: self._searching.release()
+		self.files = files; self.bytes = total
+		self.version += 1
+		return True
+
+	def _searchable(self): # Builds the search index from the committed entries, if required; called with the index locked
+		if self._tokens is None:
+			self._tokens = {}; self._folders = {}; self._extensions = {}; self._roots = {}; self._matches = ({},{}); self._dead = 0
+			self._insert(self._view[0])
+
+	def _insert(self,entries): # Adds newly committed entries to the search index
+		touched = set() # Lists of files that need to be sorted again
+		for entry in entries:
+			if self._flags[entry]&self.REMOVED or self._parent[entry]==self.ROOT: continue # Sources are named by their paths, which are not seen by anyone
+			name = self._name[entry]
+			if self._flags[entry]&self.DIRECTORY:
+				for token in tokens(name):
+					if token not in self._folders: self._token(True,token)
+					self._folders[token].append(entry)
+				continue
+			for token in tokens(name):
+				if token not in self._tokens: self._token(False,token)
+				self._tokens[token].append(entry); touched.add(("t",token))
+			if "." in name:
+				extension = name.rsplit(".",1)[1]
+				self._extensions.setdefault(extension,array.array("i")).append(entry); touched.add(("e",extension))
+			self._roots.setdefault(self.root(entry),array.array("i")).append(entry)
+		for table,key in touched:
+			table = self._tokens if table=="t" else self._extensions
+			table[key] = array.array("i",sorted(table[key],key=self._size.__getitem__))
+
+	def _token(self,directory,token): # Adds a new token to the index of files (or directories), and to the cached matches of the search terms it contains
+		(self._folders if directory else self._tokens)[token] = array.array("i")
+		for part,keys in self._matches[directory].items():
+			if part in token: keys.append(token)
+
+	def _range(self,postings,minimum,maximum): # Returns the part of a list of files sorted by size that lies within the given (inclusive) limits
+		low = 0; high = len(postings)
+		if minimum is not None:
+			first,last = 0,len(postings)
+			while first<last:
+				middle = (first+last)/2
+				if self._size[postings[middle]]<minimum: first = middle+1
+				else: last = middle
+			low = first
+		if maximum is not None:
+			first,last = low,len(postings)
+			while first<last:
+				middle = (first+last)/2
+				if self._size[postings[middle]]<=maximum: first = middle+1
+				else: last = middle
+			high = first
+		return postings[low:high]
+
+	def search(self,mask,words,extensions=None,minimum=None,maximum=None,files=True,directories=False,limit=None): # Returns up to limit committed entries visible to the groups in mask, whose lowercase names contain every one of the (lowercase) words.
+		# Files are returned if files is True, restricted to those with one of the given extensions (if any) and sizes within minimum and maximum (if given); directories are returned if directories is True.
+		# Candidates are taken from the index entries of the tokens containing the most selective part of any word, intersected with those of the other parts (where these are not much larger), and checked against everything else; the search stops as soon as limit entries have been found.
+		self._searching.acquire()
+		try:
+			self._searchable()
+			return self._search(mask,words,extensions,minimum,maximum,files,directories,limit)
+		finally: self._searching.release()
+
+	def _search(self,mask,words,extensions,minimum,maximum,files,directories,limit): # Used by search(), with the index locked
+		result = []
+		for directory,table in ((False,self._tokens),(True,self._folders)):
+			if (directories if directory else files)==False: continue
+			parts = [] # (number of entries, lists of entries) that match each part of each word
+			for word in words:
+				for part in tokens(word):
+					matches = self._matches[directory]
+					if part in matches: keys = matches[part]
+					else:
+						keys = [token for token in table if part in token] # Substrings of tokens match too, as they did when names were searched directly
+						if len(matches)>=MATCHES: matches.clear() # Terms that are seldom searched for would otherwise accumulate
+						matches[part] = keys
+					postings = [table[key] for key in keys]
+					parts.append((sum([len(item) for item in postings]),postings))
+			parts.sort(key=lambda item: item[0])
+			required = [] # Sets of entries that every result must be in, most selective first
+			if len(parts)>0:
+				candidates = parts[0][1]
+				required = [set(itertools.chain(*postings)) for count,postings in parts[1:] if count<=INTERSECT*parts[0][0]] # Larger ones would cost more to build than checking the names of the candidates
+			elif not directory and extensions is not None: candidates = [self._extensions[extension] for extension in extensions if extension in self._extensions] # Nothing to narrow the search down with but the type of the files
+			else: candidates = [[entry for entry in self._view[0] if self._flags[entry]&self.DIRECTORY==(self.DIRECTORY if directory else 0) and self._parent[entry]!=self.ROOT]]
+			if not directory and len(candidates)==1 and isinstance(candidates[0],array.array) and (minimum is not None or maximum is not None): candidates = [self._range(candidates[0],minimum,maximum)] # Sorted by size
+			seen = set()
+			for entry in itertools.chain(*candidates):
+				if self._flags[entry]&self.REMOVED or entry in seen: continue
+				seen.add(entry)
+				if len([item for item in required if entry not in item])>0: continue
+				name = self._name[entry]
+				if not directory:
+					if minimum is not None and self._size[entry]<minimum: continue
+					if maximum is not None and self._size[entry]>maximum: continue
+					if extensions is not None and ("." not in name or name.rsplit(".",1)[1] not in extensions): continue
+				lower = name.lower()
+				if len([word for word in words if word not in lower])>0: continue
+				if not self.mask(entry)&mask: continue
+				result.append(entry)
+				if limit is not None and len(result)>=limit: return result
+		return result
+
+	def search_root(self,mask,root): # Returns the committed files with the given 24 byte root that are visible to the groups in mask
+		self._searching.acquire()
+		try:
+			self._searchable()
+			return [entry for entry in self._roots.get(root,[]) if not self._flags[entry]&self.REMOVED and self.mask(entry)&mask]
+		finally: self._searching.release()
+
+	def paths(self,mask,root): # Returns the committed files with the given 24 byte root that are visible to the groups in mask as (path on disk, size, modification time, entry) tuples
+		result = []
+		for entry in self.search_root(mask,root):
+			names = self.path(entry) # Sources are named by the shared path, and hold the shared directory or file itself
+			result.append((os.path.join(os.path.dirname(names[0]),*names[1:]),self.size(entry),self.mtime(entry),entry))
+		return result
+
+	def alive(self,entry): # Whether an entry has not been removed
+		return not self._flags[entry]&self.REMOVED
+
+	def directory(self,entry): # Whether an entry is a directory
+		return self._flags[entry]&self.DIRECTORY!=0
+
+	def name(self,entry):
+		return self._name[entry]
+
+	def parent(self,entry):
+		return self._parent[entry]
+
+	def size(self,entry): # Size of a file in bytes
+		return int(self._size[entry])
+
+	def mtime(self,entry): # Modification time of a file in nanoseconds, as of when it was hashed; 0 if unknown
+		return int(self._mtime[entry])*1000
+
+	def root(self,entry): # The 24 byte root of a file
+		return str(self._tth[entry*24:entry*24+24])
+
+	def tth(self,entry): # The root of a file, base32 encoded as in filelists
+		return base64.b32encode(self.root(entry))[:-1]
+
+	def path(self,entry): # Returns the names of the directories leading to an entry, followed by that of the entry itself
+		result = []
+		while entry!=self.ROOT:
+			result.append(self._name[entry])
+			entry = self._parent[entry]
+		result.reverse()
+		return result
+
+	def locate(self,mask,names): # Returns the directories (seen as one, as in view()) found by following a list of names from the top of the view of the group(s) in a bitmask, or None if there is no such directory
+		entries = self.sources(mask)
+		for name in names:
+			entries = dict(self.view(entries)).get(name)
+			if entries is None or not self._flags[entries[0]]&self.DIRECTORY: return None
+		return entries
+
+	def xml(self,cid,generator,mask=None,directory=None,base="/",depth=None): # Yields the filelist (files.xml) of the group(s) in a bitmask, as of the last commit, piece by piece, one element per line and without indentation. If mask is omitted, the whole share is written, with every source named by its path; load() reads this back.
+		# A partial filelist is written if directory is given (the entries returned by locate(), whose path is base): it lists the contents of that directory, down to depth levels (all of them if depth is None). Directories that are not listed, but are not empty, are marked as incomplete.
+		quote = lambda x: x.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;").replace('"',"&quot;")
+		yield '<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n'
+		yield '<FileListing Base="%s" CID="%s" Generator="%s" Version="1">\n' % (quote(base),quote(cid),quote(generator))
+		if directory is None: directory = [self.ROOT] if mask is None else self.sources(mask)
+		stack = [(name,entries,1,False) for name,entries in reversed(self.view(directory))] # (name, entries seen as one, level, whether the directory is being closed)
+		while len(stack)>0:
+			name,entries,level,closing = stack.pop()
+			if closing: yield "</Directory>\n"; continue
+			entry = entries[0]
+			if not self._flags[entry]&self.DIRECTORY:
+				yield '<File Name="%s" Size="%d" TTH="%s"/>\n' % (quote(name),self._size[entry],self.tth(entry))
+				continue
+			if depth is not None and level>=depth: # Beyond the requested depth
+				if len([item for item in entries if len(self.children(item))>0])>0: yield '<Directory Name="%s" Incomplete="1"/>\n' % quote(name)
+				else: yield '<Directory Name="%s"/>\n' % quote(name)
+				continue
+			items = self.view(entries)
+			if len(items)==0:
+				yield '<Directory Name="%s"/>\n' % quote(name)
+				continue
+			yield '<Directory Name="%s">\n' % quote(name)
+			stack.append((name,entries,level,True))
+			stack.extend([(item,contents,level+1,False) for item,contents in reversed(items)])
+		yield "</FileListing>\n"
+
+	def save(self,path,key,extra=None): # Commits any changes, and writes a snapshot of the tree to a file, which restore() reads back; key identifies the configuration the tree was built for, and extra is any other data (of types supported by marshal) to be saved along with it.
+		self.commit()
+		order,first,count = self._view
+		sections = [key,self._parent.tostring(),self._size.tostring(),self._mtime.tostring(),str(self._flags),str(self._tth),"\0".join(self._name),order.tostring(),first.tostring(),count.tostring(),marshal.dumps((self._mask,self.version,self.files,self.bytes)),marshal.dumps(extra)]
+		body = "".join([struct.pack("<Q",len(section))+section for section in sections])
+		handle = open(path,"wb")
+		try: handle.write(SNAPSHOT.pack(SNAPSHOT_MAGIC,_format(),zlib.crc32(body)&0xFFFFFFFF,len(body))+body)
+		finally: handle.close()
+		return self
+
+# Header of snapshots written by ShareTree.save : magic string (including the version), format of the arrays (byte order and sizes, which depend on the platform), checksum and length of the rest of the file
+SNAPSHOT = struct.Struct("<8s16sIQ")
+SNAPSHOT_MAGIC = "PYDCSHR\x02"
+
+def _format(): # Describes the layout of the arrays in snapshots on this platform
+	return "%s %s%d i%d" % (sys.byteorder[0],SIZE,array.array(SIZE).itemsize,array.array("i").itemsize)
+
+def restore(path,key): # Returns a (ShareTree, extra) pair for a snapshot written by ShareTree.save, or None if it does not exist, is damaged, was written by another version or platform, or was built for a configuration other than key.
+	# The file is read as a whole and the arrays are copied out of it as they are, without parsing anything but the names, so restoring takes time proportional to the size of the file; everything is restored eagerly, except the (directory, name) lookup, which is only built once it is first needed (when the share is scanned again).
+	try:
+		handle = open(path,"rb")
+		try:
+			header = handle.read(SNAPSHOT.size)
+			if len(header)<SNAPSHOT.size: return None
+			magic,format,checksum,length = SNAPSHOT.unpack(header)
+			if magic!=SNAPSHOT_MAGIC or format.rstrip("\0")!=_format() or os.fstat(handle.fileno()).st_size!=SNAPSHOT.size+length: return None
+			body = handle.read()
+		finally: handle.close()
+	except EnvironmentError: return None
+	try:
+		if zlib.crc32(body)&0xFFFFFFFF!=checksum: return None
+		sections = []; offset = 0
+		while offset<len(body):
+			size = struct.unpack_from("<Q",body,offset)[0]
+			sections.append(body[offset+8:offset+8+size]); offset += 8+size
+		if len(sections)!=12 or sections[0]!=key: return None
+		tree = ShareTree()
+		tree._parent = array.array("i",sections[1])
+		tree._size = array.array(SIZE,sections[2])
+		tree._mtime = array.array(SIZE,sections[3])
+		tree._flags = bytearray(sections[4])
+		tree._tth = bytearray(sections[5])
+		tree._name = map(_intern,sections[6].split("\0"))
+		tree._view = (array.array("i",sections[7]),array.array("i",sections[8]),array.array("i",sections[9]))
+		tree._mask,tree.version,tree.files,tree.bytes = marshal.loads(sections[10])
+		tree._lookup = None
+		if not len(tree._name)==len(tree._parent)==len(tree._size)==len(tree._mtime)==len(tree._flags)==len(tree._tth)/24==len(tree._view[1])==len(tree._view[2]): return None
+		return tree,marshal.loads(sections[11])
+	except (struct.error,ValueError,EOFError,TypeError): return None
+
+class BZ2Reader:
+	"""
+	A file-like object that reads the decompressed contents of a bz2 file consisting of one or more streams, one after the other, as written by parallel compressors (Python 2's bz2.BZ2File only reads the first one).
+	"""
+	def __init__(self,handle,buffer=1024*100):
+		self._handle = handle # The compressed file
+		self._buffer = buffer # Number of compressed bytes read at a time
+		self._decompressor = bz2.BZ2Decompressor()
+		self._data = "" # Decompressed data that has not been read yet
+		self._input = "" # Compressed data that has not been decompressed yet
+
+	def read(self,size=-1): # Returns up to size bytes (everything, if size is negative), or an empty string at the end of the file
+		result = []; length = len(self._data)
+		result.append(self._data); self._data = ""
+		while size<0 or length<size:
+			if len(self._input)==0: self._input = self._handle.read(self._buffer)
+			if len(self._input)==0: break # End of file
+			try: data = self._decompressor.decompress(self._input)
+			except EOFError: # The previous stream ended exactly where the last read did
+				self._decompressor = bz2.BZ2Decompressor(); continue
+			self._input = self._decompressor.unused_data
+			if len(self._input)>0: self._decompressor = bz2.BZ2Decompressor() # Another stream follows
+			result.append(data); length += len(data)
+		result = "".join(result)
+		if size>=0: result,self._data = result[:size],result[size:]
+		return result
+
+	def close(self):
+		self._handle.close()
+
+def compress(data): # Compresses a block of data into a complete bz2 stream; used by worker processes, whose streams are concatenated
+	return bz2.compress(data)
+
+def load(path): # Reads a filelist (files.xml, or files.xml.bz2 if the name ends with .bz2), such as one written by ShareTree.xml() without a mask, into a new ShareTree, without holding the whole document in memory.
+	tree = ShareTree()
+	handle = BZ2Reader(open(path,"rb")) if path.endswith(".bz2") else open(path,"rb")
+	stack = [] # Entries of the open Directory (or FileListing) elements
+	try:
+		for event,element in ElementTree.iterparse(handle,("start","end")):
+			if event=="start":
+				if element.tag=="FileListing": stack.append(tree.ROOT)
+				elif element.tag=="Directory" and len(stack)>0: stack.append(tree.add(stack[-1],element.get("Name","")))
+				elif element.tag=="File" and len(stack)>0:
+					try: tree.add(stack[-1],element.get("Name",""),int(element.get("Size")),element.get("TTH"))
+					except (TypeError,ValueError): pass # Incomplete entry, to be hashed again
+			else:
+				if element.tag in ("FileListing","Directory") and len(stack)>0: stack.pop()
+				element.clear()
+	finally: handle.close()
+	tree.commit()
+	return tree
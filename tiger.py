@@ -18,6 +18,9 @@ OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 import array, struct
 import math, base64
 
+try: import numpy # Optional : Used by hash_lanes() to hash many messages at once
+except ImportError: numpy = None
+
 t1 = [ 0x02AAB17CF7E90C5E   ,	0xAC424B03E243A8EC   ,
 	0x72CD5BE30DD5FCD3   ,	0x6D019B93F6F97F3A   ,
 	0xCD9978FFD21F9193   ,	0x7573A1C9708029E2   ,
@@ -533,131 +536,222 @@ t4 = [ 0x5B0E608526323C55   ,	0x1A46C1A9FA1B59F5   ,
 	0xCB0C0708705A36A3   ,	0xE74D14754F986044   ,
 	0xCD56D9430EA8280E   ,	0xC12591D7535F5065   ,
 	0xC83223F1720AEF96   ,	0xC3A0396F7363A51F   ]
-
-def tiger_round(a,b,c,x,mul):
-	c ^= x
-	c &= 0xffffffffffffffff
-	a -= t1[((c) >> (0*8))&0xFF] ^ t2[((c) >> ( 2*8)) & 0xFF] ^ t3[((c) >> (4*8))&0xFF] ^ t4[((c) >> ( 6*8)) & 0xFF]
-	b += t4[((c) >> (1*8))&0xFF] ^ t3[((c) >> ( 3*8)) & 0xFF] ^ t2[((c) >> (5*8))&0xFF] ^ t1[((c) >> ( 7*8)) & 0xFF]
-	b *= mul
-	a &= 0xffffffffffffffff
-	b &= 0xffffffffffffffff
-	c &= 0xffffffffffffffff
-	return {"a": a, "b":b, "c": c}
-
-def tiger_pass(a,b,c,mul, mystr):
-	values = tiger_round(a,b,c, mystr[0], mul)
-	values = tiger_round(values["b"], values["c"], values["a"],mystr[1],mul)
-	values = { "b": values["a"], "c": values["b"], "a": values["c"] }
-	values = tiger_round(values["c"], values["a"], values["b"], mystr[2], mul)
-	values = { "c": values["a"], "a": values["b"], "b": values["c"] }
-	values = tiger_round(values["a"], values["b"], values["c"],mystr[3],mul)
-	values = tiger_round(values["b"], values["c"], values["a"],mystr[4],mul)
-	values = { "b": values["a"], "c": values["b"], "a": values["c"] }
-	values = tiger_round(values["c"], values["a"], values["b"],mystr[5],mul)
-	values = { "c": values["a"], "a":values["b"], "b": values["c"] }
-	values = tiger_round(values["a"], values["b"], values["c"],mystr[6],mul)
-	values = tiger_round(values["b"], values["c"], values["a"],mystr[7],mul)
-	values = { "b": values["a"], "c":values["b"], "a": values["c"]}
-	return values
-
-def tiger_compress(str, res):
-	#setup
+def tiger_compress(str, res, offset=0):
+	# The 64 byte block at the given offset is mixed into the three state words held in res.
+	# All 24 rounds are unrolled into local variables, so that no intermediate objects are created per block.
 	a = res[0]
 	b = res[1]
 	c = res[2]
-	
-	x = []
-
-	for j in range(0,8):
-		x.append(struct.unpack('Q', str[j*8:j*8+8])[0])
-
-	# compress
+	x0, x1, x2, x3, x4, x5, x6, x7 = struct.unpack_from('<8Q', str, offset)
 	aa = a
 	bb = b
 	cc = c
 	allf = 0xFFFFFFFFFFFFFFFF
-	for i in range(0, 3):
-		if i != 0:
-			x[0] = (x[0] - (x[7] ^ 0xA5A5A5A5A5A5A5A5)&allf ) & allf
-			x[1] ^= x[0]
-			x[2] = (x[2] + x[1]) & allf
-			x[3] = (x[3] - (x[2] ^ (~x[1]&allf) << 19)&allf) & allf
-			x[4] ^= x[3]
-			x[5] = (x[5] + x[4]) & allf
-			x[6] = (x[6] - (x[5] ^ (~x[4]&allf) >> 23)&allf) & allf
-			x[7] ^= x[6]
-			x[0] = (x[0] + x[7]) & allf
-			x[1] = (x[1] - (x[0] ^ (~x[7]&allf) << 19)&allf) & allf
-			x[2] ^= x[1]
-			x[3] = (x[3] + x[2]) & allf
-			x[4] = (x[4] - (x[3] ^ (~x[2]&allf) >> 23)&allf) & allf
-			x[5] ^= x[4] 
-			x[6] = (x[6] + x[5]) & allf
-			x[7] = (x[7] - (x[6] ^ 0x0123456789ABCDEF)&allf ) & allf
+	T1 = t1; T2 = t2; T3 = t3; T4 = t4
+	for mul in (5, 7, 9):
+		if mul != 5: # key schedule
+			x0 = (x0 - (x7 ^ 0xA5A5A5A5A5A5A5A5)) & allf
+			x1 ^= x0
+			x2 = (x2 + x1) & allf
+			x3 = (x3 - (x2 ^ (((~x1) & allf) << 19) & allf)) & allf
+			x4 ^= x3
+			x5 = (x5 + x4) & allf
+			x6 = (x6 - (x5 ^ (((~x4) & allf) >> 23))) & allf
+			x7 ^= x6
+			x0 = (x0 + x7) & allf
+			x1 = (x1 - (x0 ^ (((~x7) & allf) << 19) & allf)) & allf
+			x2 ^= x1
+			x3 = (x3 + x2) & allf
+			x4 = (x4 - (x3 ^ (((~x2) & allf) >> 23))) & allf
+			x5 ^= x4
+			x6 = (x6 + x5) & allf
+			x7 = (x7 - (x6 ^ 0x0123456789ABCDEF)) & allf
+		# round (a,b,c,x0)
+		c ^= x0
+		a = (a - (T1[c & 0xFF] ^ T2[(c >> 16) & 0xFF] ^ T3[(c >> 32) & 0xFF] ^ T4[(c >> 48) & 0xFF])) & allf
+		b = ((b + (T4[(c >> 8) & 0xFF] ^ T3[(c >> 24) & 0xFF] ^ T2[(c >> 40) & 0xFF] ^ T1[c >> 56])) * mul) & allf
+		# round (b,c,a,x1)
+		a ^= x1
+		b = (b - (T1[a & 0xFF] ^ T2[(a >> 16) & 0xFF] ^ T3[(a >> 32) & 0xFF] ^ T4[(a >> 48) & 0xFF])) & allf
+		c = ((c + (T4[(a >> 8) & 0xFF] ^ T3[(a >> 24) & 0xFF] ^ T2[(a >> 40) & 0xFF] ^ T1[a >> 56])) * mul) & allf
+		# round (c,a,b,x2)
+		b ^= x2
+		c = (c - (T1[b & 0xFF] ^ T2[(b >> 16) & 0xFF] ^ T3[(b >> 32) & 0xFF] ^ T4[(b >> 48) & 0xFF])) & allf
+		a = ((a + (T4[(b >> 8) & 0xFF] ^ T3[(b >> 24) & 0xFF] ^ T2[(b >> 40) & 0xFF] ^ T1[b >> 56])) * mul) & allf
+		# round (a,b,c,x3)
+		c ^= x3
+		a = (a - (T1[c & 0xFF] ^ T2[(c >> 16) & 0xFF] ^ T3[(c >> 32) & 0xFF] ^ T4[(c >> 48) & 0xFF])) & allf
+		b = ((b + (T4[(c >> 8) & 0xFF] ^ T3[(c >> 24) & 0xFF] ^ T2[(c >> 40) & 0xFF] ^ T1[c >> 56])) * mul) & allf
+		# round (b,c,a,x4)
+		a ^= x4
+		b = (b - (T1[a & 0xFF] ^ T2[(a >> 16) & 0xFF] ^ T3[(a >> 32) & 0xFF] ^ T4[(a >> 48) & 0xFF])) & allf
+		c = ((c + (T4[(a >> 8) & 0xFF] ^ T3[(a >> 24) & 0xFF] ^ T2[(a >> 40) & 0xFF] ^ T1[a >> 56])) * mul) & allf
+		# round (c,a,b,x5)
+		b ^= x5
+		c = (c - (T1[b & 0xFF] ^ T2[(b >> 16) & 0xFF] ^ T3[(b >> 32) & 0xFF] ^ T4[(b >> 48) & 0xFF])) & allf
+		a = ((a + (T4[(b >> 8) & 0xFF] ^ T3[(b >> 24) & 0xFF] ^ T2[(b >> 40) & 0xFF] ^ T1[b >> 56])) * mul) & allf
+		# round (a,b,c,x6)
+		c ^= x6
+		a = (a - (T1[c & 0xFF] ^ T2[(c >> 16) & 0xFF] ^ T3[(c >> 32) & 0xFF] ^ T4[(c >> 48) & 0xFF])) & allf
+		b = ((b + (T4[(c >> 8) & 0xFF] ^ T3[(c >> 24) & 0xFF] ^ T2[(c >> 40) & 0xFF] ^ T1[c >> 56])) * mul) & allf
+		# round (b,c,a,x7)
+		a ^= x7
+		b = (b - (T1[a & 0xFF] ^ T2[(a >> 16) & 0xFF] ^ T3[(a >> 32) & 0xFF] ^ T4[(a >> 48) & 0xFF])) & allf
+		c = ((c + (T4[(a >> 8) & 0xFF] ^ T3[(a >> 24) & 0xFF] ^ T2[(a >> 40) & 0xFF] ^ T1[a >> 56])) * mul) & allf
+		# the next pass starts with the registers rotated
+		a, b, c = c, a, b
+	# after three rotations the registers are back in place; feed forward
+	res[0] = a ^ aa
+	res[1] = (b - bb) & allf
+	res[2] = (c + cc) & allf
 
-		if i == 0:
-			vals = tiger_pass(a,b,c,5, x)
-			a = vals['a']
-			b = vals['b']
-			c = vals['c']
-		elif i == 1:
-			vals = tiger_pass(a,b,c,7, x)
-			a = vals['a']
-			b = vals['b']
-			c = vals['c']
-		else:
-			vals = tiger_pass(a,b,c,9, x)
-			a = vals['a']
-			b = vals['b']
-			c = vals['c']
-		tmpa = a
-		a = c
-		c = b
-		b = tmpa
-	a ^= aa
-	b = (b - bb) & allf
-	c = (c + cc) & allf
+class Tiger:
+	"""
+	A hashlib-style Tiger hash object.
+	Data may be fed in pieces using update(); digest() and hexdigest() may be called at any time without disturbing the state, so hashing can continue afterwards.
+	digest() returns the standard 24 byte little-endian digest (as used by the Tiger Tree Hash), while the module level hash() function retains its original representation.
+	"""
+	name = "tiger"
+	digest_size = 24
+	block_size = 64
+
+	def __init__(self, data=""):
+		self._state = [0x0123456789ABCDEF, 0xFEDCBA9876543210, 0xF096A5B4C3B2E187]
+		self._buffer = "" # Data that has not yet filled a complete 64 byte block
+		self._length = 0 # Total number of bytes fed so far
+		if data: self.update(data)
 
-	# map values out
-	res[0] = a
-	res[1] = b
-	res[2] = c
+	def update(self, data):
+		"Feeds more data into the hash object."
+		length = len(data)
+		self._length += length
+		if self._buffer:
+			fill = 64 - len(self._buffer)
+			if length < fill:
+				self._buffer += data
+				return self
+			tiger_compress(self._buffer + data[:fill], self._state)
+			offset = fill
+		else: offset = 0
+		state = self._state
+		end = length - 63
+		while offset < end:
+			tiger_compress(data, state, offset)
+			offset += 64
+		self._buffer = data[offset:]
+		return self
+
+	def copy(self):
+		"Returns an independent copy of this hash object."
+		other = Tiger()
+		other._state = self._state[:]
+		other._buffer = self._buffer
+		other._length = self._length
+		return other
+
+	def words(self):
+		"Returns the three 64-bit words of the final state."
+		state = self._state[:]
+		tail = self._buffer + chr(0x01)
+		tail += chr(0) * ((56 - len(tail)) % 64)
+		tail += struct.pack('<Q', (self._length << 3) & 0xFFFFFFFFFFFFFFFF)
+		tiger_compress(tail, state)
+		if len(tail) == 128: tiger_compress(tail, state, 64)
+		return state
+
+	def digest(self):
+		"Returns the 24 byte binary digest of the data fed so far."
+		return struct.pack('<3Q', *self.words())
+
+	def hexdigest(self):
+		"Returns the digest as a string of 48 hexadecimal characters."
+		return self.digest().encode('hex')
+
+def new(data=""):
+	return Tiger(data)
 
 def hash(str):
-	i = 0
+	return "%016X%016X%016X" % tuple(Tiger(str).words())
 
-	res = [0x0123456789ABCDEF, 0xFEDCBA9876543210, 0xF096A5B4C3B2E187]
-	offset = 0
-	length = len(str)
-	while i < length-63:
-		tiger_compress( str[i:i+64], res )
-		i += 64
-	temp = array.array('c', str[i:])
-	j = len(temp)
-	temp.append(chr(0x01))
-	j += 1
-	
-	while j&7 != 0:
-		temp.append(chr(0))
-		j += 1
+LANES_MIN = 16 # Batches smaller than this are hashed one message at a time, as the array setup would cost more than it saves.
+if numpy is not None:
+	T1 = numpy.array(t1, dtype=numpy.uint64)
+	T2 = numpy.array(t2, dtype=numpy.uint64)
+	T3 = numpy.array(t3, dtype=numpy.uint64)
+	T4 = numpy.array(t4, dtype=numpy.uint64)
+	MASK = numpy.uint64(0xFF)
+	SHIFT = [numpy.uint64(i) for i in range(64)]
 
-	if j > 56:
-		while j < 64:
-			temp.append(chr(0))
-			j += 1
-		tiger_compress(temp, res)
-		j = 0
+def hash_lanes(data, width, prefix=""):
+	# Hashes every width-sized slice of data (each preceded by prefix), returning a list of 24 byte digests.
+	# With NumPy available, all slices are processed together as lanes of uint64 arrays, with the S-box lookups done as gathers across lanes.
+	count = len(data) // width
+	if numpy is None or count < LANES_MIN:
+		return [Tiger(prefix + data[i*width:(i+1)*width]).digest() for i in range(count)]
+	length = len(prefix) + width
+	padded = (length + 9 + 63) // 64 * 64 # Message, 0x01 marker and 8 byte length, rounded up to complete blocks
+	lanes = numpy.zeros((count, padded), dtype=numpy.uint8)
+	if prefix: lanes[:, :len(prefix)] = numpy.frombuffer(prefix, dtype=numpy.uint8)
+	lanes[:, len(prefix):length] = numpy.frombuffer(data, dtype=numpy.uint8, count=count*width).reshape(count, width)
+	lanes[:, length] = 0x01
+	lanes[:, padded-8:] = numpy.frombuffer(struct.pack('<Q', (length << 3) & 0xFFFFFFFFFFFFFFFF), dtype=numpy.uint8)
+	words = lanes.view('<u8').astype(numpy.uint64)
+	del lanes
+	a = numpy.empty(count, dtype=numpy.uint64); a.fill(0x0123456789ABCDEF)
+	b = numpy.empty(count, dtype=numpy.uint64); b.fill(0xFEDCBA9876543210)
+	c = numpy.empty(count, dtype=numpy.uint64); c.fill(0xF096A5B4C3B2E187)
+	for block in range(padded // 64):
+		x = [numpy.ascontiguousarray(words[:, block*8+j]) for j in range(8)]
+		a, b, c = _lanes_compress(a, b, c, x)
+	result = numpy.empty((count, 3), dtype='<u8')
+	result[:, 0] = a; result[:, 1] = b; result[:, 2] = c
+	result = result.tostring()
+	return [result[i*24:i*24+24] for i in range(count)]
 
-	# make the first 56 bytes 0
-	temp.extend([chr(0) for i in range(0, 56-j)])
-	while j < 56:
-		temp[j] = chr(0)
-		j += 1
-	while len(temp) > 56:
-		temp.pop(56)
+def hash_many(messages):
+	# Hashes a list of equal-length strings, returning a list of 24 byte digests.
+	if len(messages) == 0: return []
+	width = len(messages[0])
+	if width == 0: return [Tiger().digest() for message in messages]
+	return hash_lanes("".join(messages), width)
 
-	temp.fromstring(struct.pack('Q', length<<3))
-	tiger_compress(temp, res)
-	
-	return "%016X%016X%016X" % (res[0], res[1], res[2])
\ No newline at end of file
+def _lanes_round(a, b, c, x, mul):
+	# One Tiger round applied to all lanes; uint64 arithmetic wraps around on its own.
+	c ^= x
+	a -= T1[c & MASK] ^ T2[(c >> SHIFT[16]) & MASK] ^ T3[(c >> SHIFT[32]) & MASK] ^ T4[(c >> SHIFT[48]) & MASK]
+	b += T4[(c >> SHIFT[8]) & MASK] ^ T3[(c >> SHIFT[24]) & MASK] ^ T2[(c >> SHIFT[40]) & MASK] ^ T1[c >> SHIFT[56]]
+	b *= mul
+
+def _lanes_compress(a, b, c, x):
+	aa = a.copy(); bb = b.copy(); cc = c.copy()
+	for mul in (numpy.uint64(5), numpy.uint64(7), numpy.uint64(9)):
+		if mul != 5: # key schedule
+			x[0] -= x[7] ^ numpy.uint64(0xA5A5A5A5A5A5A5A5)
+			x[1] ^= x[0]
+			x[2] += x[1]
+			x[3] -= x[2] ^ ((~x[1]) << SHIFT[19])
+			x[4] ^= x[3]
+			x[5] += x[4]
+			x[6] -= x[5] ^ ((~x[4]) >> SHIFT[23])
+			x[7] ^= x[6]
+			x[0] += x[7]
+			x[1] -= x[0] ^ ((~x[7]) << SHIFT[19])
+			x[2] ^= x[1]
+			x[3] += x[2]
+			x[4] -= x[3] ^ ((~x[2]) >> SHIFT[23])
+			x[5] ^= x[4]
+			x[6] += x[5]
+			x[7] -= x[6] ^ numpy.uint64(0x0123456789ABCDEF)
+		_lanes_round(a, b, c, x[0], mul)
+		_lanes_round(b, c, a, x[1], mul)
+		_lanes_round(c, a, b, x[2], mul)
+		_lanes_round(a, b, c, x[3], mul)
+		_lanes_round(b, c, a, x[4], mul)
+		_lanes_round(c, a, b, x[5], mul)
+		_lanes_round(a, b, c, x[6], mul)
+		_lanes_round(b, c, a, x[7], mul)
+		a, b, c = c, a, b
+	a ^= aa
+	b -= bb
+	c += cc
+	return a, b, c
@@ -0,0 +1,323 @@
+import base64, heapq, mmap, multiprocessing, os, struct, threading
+import tiger
+
+class TigerTree:
+	"""
+	Incremental builder for Tiger Tree Hashes (Merkle trees of 1024 byte leaves, as used by Direct Connect), fed in pieces of any size using update().
+	Only the roots of complete subtrees are kept, so O(log n) hashes are held in memory regardless of the size of the data.
+	If a level is given, the nodes at that height (0 being the leaves) are retained as well, so that the tree can be served to peers (TTHL); see nodes().
+	"""
+	blocksize = 1024
+
+	def __init__(self,data="",lanes=4096,level=None):
+		self._stack = [] # List of [height,hash] pairs representing complete subtrees
+		self._level = level # Height of the nodes to be retained, if any
+		self._nodes = [] # Complete nodes at that height, from left to right
+		self._buffer = "" # Data that does not yet make up a complete leaf
+		self._length = 0 # Number of bytes fed so far
+		self._lanes = lanes # Number of leaves hashed together in one batch
+		if data: self.update(data)
+
+	def update(self,data): # Feeds more data into the tree.
+		self._length += len(data)
+		if self._buffer:
+			fill = self.blocksize-len(self._buffer)
+			if len(data)<fill:
+				self._buffer += data
+				return self
+			self._push(0,tiger.Tiger(chr(0)+self._buffer+data[:fill]).digest())
+			data = data[fill:]
+		chunk = self.blocksize*self._lanes
+		offset = 0
+		while len(data)-offset>=self.blocksize:
+			block = data[offset:offset+chunk] if offset>0 or len(data)>chunk else data
+			for leaf in tiger.hash_lanes(block,self.blocksize,chr(0)): self._push(0,leaf)
+			offset += (len(block)/self.blocksize)*self.blocksize
+		self._buffer = data[offset:]
+		return self
+
+	def _push(self,height,node,fresh=True): # Places a subtree root on the stack, combining it with its left sibling(s) where possible.
+		stack = self._stack
+		if fresh and height==self._level: self._nodes.append(node)
+		while len(stack)>0 and stack[-1][0]==height:
+			node = tiger.Tiger(chr(1)+stack.pop()[1]+node).digest()
+			height += 1
+			if height==self._level: self._nodes.append(node)
+		stack.append([height,node])
+
+	def extend(self,stack,length,nodes=()): # Appends complete subtrees hashed elsewhere, covering the next length bytes of data. Only valid at a leaf boundary.
+		self._length += length
+		self._nodes.extend(nodes) # Complete nodes at the retained height, which were created by whoever hashed these subtrees
+		for height,node in stack: self._push(height,node,False)
+		return self
+
+	def stack(self): # Returns the subtree roots making up the data fed so far, including a short last leaf, as a list of [height,hash] pairs.
+		stack = [list(item) for item in self._stack]
+		if len(self._buffer)>0 or self._length==0: stack.append([0,tiger.Tiger(chr(0)+self._buffer).digest()]) # The last leaf may be shorter; an empty input has one empty leaf.
+		return stack
+
+	def nodes(self): # Returns the concatenated nodes at the retained height, the last of which may cover fewer leaves than the others.
+		if self._level is None: return None
+		stack = [node for height,node in self._stack if height<self._level] # Subtrees to the right of the last complete node
+		if len(self._buffer)>0 or self._length==0: stack.append(tiger.Tiger(chr(0)+self._buffer).digest()) # Followed by the short last leaf, if any
+		if len(stack)==0: return "".join(self._nodes)
+		tail = stack.pop()
+		while len(stack)>0: tail = tiger.Tiger(chr(1)+stack.pop()+tail).digest()
+		return "".join(self._nodes)+tail
+
+	def length(self): # Number of bytes fed so far.
+		return self._length
+
+	def digest(self): # Returns the 24 byte root of the data fed so far, without modifying the state.
+		stack = [node for height,node in self.stack()]
+		root = stack.pop()
+		while len(stack)>0: root = tiger.Tiger(chr(1)+stack.pop()+root).digest()
+		return root
+
+	def base32(self): # Returns the root in the 39 character base32 representation used in filelists and searches.
+		return base64.b32encode(self.digest())[:-1]
+
+def level(size,depth): # Returns the height of the tree level that has at most 2**depth nodes, for a file of the given size.
+	leaves = max(1,(size+TigerTree.blocksize-1)/TigerTree.blocksize)
+	height = 0
+	while (leaves+(1<<height)-1)>>height > (1<<depth): height += 1
+	return height
+
+def root(nodes,size): # Returns (height, root) if the concatenated nodes make up a complete level of the tree of a file of the given size, or None otherwise.
+	count = len(nodes)/24
+	if count==0 or len(nodes)%24!=0: return None
+	leaves = max(1,(size+TigerTree.blocksize-1)/TigerTree.blocksize)
+	height = 0
+	while (leaves+(1<<height)-1)>>height > count: height += 1
+	if (leaves+(1<<height)-1)>>height != count: return None
+	level = [nodes[i*24:i*24+24] for i in range(count)]
+	while len(level)>1: # Combine pairs, promoting the unpaired last node untouched
+		level = [tiger.Tiger(chr(1)+level[i]+level[i+1]).digest() for i in range(0,len(level)-1,2)]+([level[-1]] if len(level)%2==1 else [])
+	return height,level[0]
+
+def subtree(path,offset,length,lanes=4096,buffer=1024*1024*4,level=None):
+	# Hashes length bytes of the file starting at offset (which must lie on a leaf boundary), returning the resulting stack of complete subtree roots, the complete nodes at the given level, and the data of a short last leaf.
+	# The file is read through a memory map of just that range, so that worker processes can share the page cache instead of having data copied to them.
+	handle = open(path,"rb")
+	try:
+		tree = TigerTree(lanes=lanes,level=level)
+		if length>0:
+			view = mmap.mmap(handle.fileno(),length,access=mmap.ACCESS_READ,offset=offset)
+			try:
+				for start in range(0,length,buffer): tree.update(view[start:start+buffer])
+			finally: view.close()
+		return tree._stack, tree._nodes, tree._buffer
+	finally: handle.close()
+
+def _subtree(args): # Pool.imap only passes a single argument
+	return subtree(*args)
+
+def parallel(path,processes=None,lanes=4096,buffer=1024*1024*4,pool=None,level=None):
+	# Hashes a single file across worker processes, returning a TigerTree with the same root (and nodes) as hashing it serially.
+	# The file is split into ranges whose number of leaves is the same power of two, so every range (except the last) is a complete subtree aligned within the tree.
+	# Each worker hashes one range, and the subtree roots are merged in order into the final tree.
+	if processes is None or processes<1: processes = multiprocessing.cpu_count()
+	size = os.path.getsize(path)
+	leaves = (size+TigerTree.blocksize-1)/TigerTree.blocksize
+	span = 1024 # Leaves per range : At least 1MB, which also keeps offsets aligned for mmap
+	while span*processes*4<leaves: span *= 2 # About four ranges per process, to even out the load
+	step = span*TigerTree.blocksize
+	ranges = [(path,offset,min(step,size-offset),lanes,buffer,level) for offset in range(0,size,step)]
+	tree = TigerTree(lanes=lanes,level=level)
+	if len(ranges)==0: return tree
+	owned = pool is None
+	if owned: pool = multiprocessing.Pool(min(processes,len(ranges)))
+	try:
+		for args,(stack,nodes,buffer) in zip(ranges,pool.imap(_subtree,ranges)):
+			tree.extend(stack,args[2]-len(buffer),nodes)
+			tree.update(buffer) # Only the last range can end with a short leaf
+	finally:
+		if owned:
+			pool.close(); pool.join()
+	return tree
+
+def hash_files(paths,lanes=4096,buffer=1024*1024*4,depth=10):
+	# Hashes a batch of whole files one after the other, returning a list of (path, root (base32), length, height, nodes) tuples, with root None for files that could not be read.
+	# Used by worker processes while hashing a share, so only small, picklable results are sent back to the parent.
+	result = []
+	for path in paths:
+		try:
+			handle = open(path,"rb")
+			try:
+				tree = TigerTree(lanes=lanes,level=level(os.fstat(handle.fileno()).st_size,depth))
+				while True:
+					data = handle.read(buffer)
+					if data=="": break
+					tree.update(data)
+			finally: handle.close()
+		except EnvironmentError:
+			result.append((path,None,0,0,"")); continue
+		result.append((path,tree.base32(),tree.length(),tree._level,tree.nodes()))
+	return result
+
+def _hash_files(args): # Pool.imap_unordered only passes a single argument
+	return hash_files(*args)
+
+def batches(files,count): # Splits a list of (path, size) pairs into at most count lists of paths with roughly equal total sizes, largest first.
+	bins = [[] for i in range(max(1,min(count,len(files))))]
+	heap = [(0,i) for i in range(len(bins))] # (total size, batch) : The smallest batch is always on top
+	for path,size in sorted(files,key=lambda x: x[1],reverse=True): # Largest first, each into the currently smallest batch
+		total,i = heap[0]
+		bins[i].append(path)
+		heapq.heapreplace(heap,(total+max(size,TigerTree.blocksize),i)) # Even empty files cost an open()
+	totals = dict([(i,total) for total,i in heap])
+	return [bins[i] for i in sorted(range(len(bins)),key=lambda i: totals[i],reverse=True) if len(bins[i])>0]
+
+class TreeStore:
+	"""
+	A compact, append-only binary store of tree levels (as returned by TigerTree.nodes()), keyed by root.
+	The file begins with a magic string, followed by one record per tree: root (24 bytes), file size (8 bytes), height of the stored level (1 byte), number of nodes (4 bytes), and the nodes themselves (24 bytes each).
+	Only an index of the records is kept in memory; the nodes are read from disk when requested.
+	"""
+	magic = "PYDCTTHL\x01"
+	header = struct.Struct("<24sQBI")
+
+	def __init__(self,path):
+		self._path = path
+		self._index = {} # root -> (offset of nodes, file size, height, number of nodes)
+		self._lock = threading.Lock()
+		self.load()
+
+	def load(self): # Reads the index of all records in the store, discarding a damaged tail (eg: after a crash).
+		self._index = {}
+		if not os.path.isfile(self._path) or os.path.getsize(self._path)<len(self.magic):
+			handle = open(self._path,"wb"); handle.write(self.magic); handle.close()
+			return self
+		handle = open(self._path,"rb")
+		if handle.read(len(self.magic))!=self.magic: # Unknown format, start afresh
+			handle.close()
+			handle = open(self._path,"wb"); handle.write(self.magic); handle.close()
+			return self
+		end = os.path.getsize(self._path)
+		offset = len(self.magic)
+		while offset+self.header.size<=end:
+			root,size,height,count = self.header.unpack(handle.read(self.header.size))
+			if offset+self.header.size+count*24>end: break
+			self._index[root] = (offset+self.header.size,size,height,count)
+			offset += self.header.size+count*24
+			handle.seek(offset)
+		handle.close()
+		if offset<end: # Truncated record
+			handle = open(self._path,"r+b"); handle.truncate(offset); handle.close()
+		return self
+
+	def put(self,tth,size,height,nodes): # Stores a level of the tree with the given root (base32), unless an identical one exists.
+		root = base64.b32decode(tth+"=")
+		self._lock.acquire()
+		try:
+			if root in self._index and self._index[root][2]==height: return self
+			handle = open(self._path,"ab")
+			handle.seek(0,2)
+			offset = handle.tell()
+			handle.write(self.header.pack(root,size,height,len(nodes)/24)+nodes)
+			handle.close()
+			self._index[root] = (offset+self.header.size,size,height,len(nodes)/24)
+		finally: self._lock.release()
+		return self
+
+	def get(self,tth): # Returns (file size, height, nodes) for the given root (base32), or None if it isnt stored.
+		try: root = base64.b32decode(tth+"=")
+		except TypeError: return None
+		self._lock.acquire()
+		try:
+			if root not in self._index: return None
+			offset,size,height,count = self._index[root]
+			handle = open(self._path,"rb"); handle.seek(offset)
+			nodes = handle.read(count*24); handle.close()
+		finally: self._lock.release()
+		return (size,height,nodes)
+
+	def __contains__(self,tth):
+		try: return base64.b32decode(tth+"=") in self._index
+		except TypeError: return False
+
+class HashCache:
+	"""
+	A persistent, append-only binary index of the roots of files that have already been hashed, so that an unchanged share need not be hashed again after a restart.
+	Files are identified by device and inode, and a root is only considered valid while the size and modification time (in nanoseconds) recorded with it still match.
+	The file begins with a magic string, followed by fixed size records: device, inode, size, mtime (8 bytes each) and root (24 bytes). Later records supersede earlier ones for the same file.
+	The whole index is kept in memory (about 100 bytes per file), and the file is rewritten when most of its records have been superseded.
+	"""
+	magic = "PYDCHASH\x01"
+	record = struct.Struct("<QQQq24s")
+
+	def __init__(self,path):
+		self._path = path
+		self._index = {} # (device, inode) -> (size, mtime, root)
+		self._records = 0 # Number of records in the file, including superseded ones
+		self._lock = threading.Lock()
+		self.load()
+
+	def load(self): # Reads all records, discarding a damaged tail (eg: after a crash), and compacts the file if required.
+		self._index = {}
+		self._records = 0
+		if not os.path.isfile(self._path) or os.path.getsize(self._path)<len(self.magic):
+			handle = open(self._path,"wb"); handle.write(self.magic); handle.close()
+			return self
+		handle = open(self._path,"rb")
+		if handle.read(len(self.magic))!=self.magic: # Unknown format, start afresh
+			handle.close()
+			handle = open(self._path,"wb"); handle.write(self.magic); handle.close()
+			return self
+		while True:
+			data = handle.read(self.record.size*4096)
+			count = len(data)/self.record.size
+			for i in range(count):
+				device,inode,size,mtime,root = self.record.unpack_from(data,i*self.record.size)
+				self._index[(device,inode)] = (size,mtime,root)
+			self._records += count
+			if len(data)<self.record.size*4096: break
+		handle.close()
+		end = len(self.magic)+self._records*self.record.size
+		if end<os.path.getsize(self._path): # Truncated record
+			handle = open(self._path,"r+b"); handle.truncate(end); handle.close()
+		if self._records>1024 and self._records>2*len(self._index): self.compact()
+		return self
+
+	def compact(self): # Rewrites the file with only the current record of every file.
+		self._lock.acquire()
+		try:
+			handle = open(self._path+".tmp","wb")
+			handle.write(self.magic)
+			for (device,inode),(size,mtime,root) in self._index.iteritems(): handle.write(self.record.pack(device,inode,size,mtime,root))
+			handle.close()
+			if os.path.exists(self._path): os.remove(self._path) # Windows does not allow rename to replace a file
+			os.rename(self._path+".tmp",self._path)
+			self._records = len(self._index)
+		finally: self._lock.release()
+		return self
+
+	def get(self,device,inode,size,mtime): # Returns the root (base32) of the given file, or None if it isnt known or the file has changed since.
+		if inode==0: return None # No reliable identity (eg: stat on Windows)
+		entry = self._index.get((device,inode))
+		if entry is None or entry[0]!=size or entry[1]!=mtime: return None
+		return base64.b32encode(entry[2])[:-1]
+
+	def put(self,device,inode,size,mtime,tth): # Records the root (base32) of the given file.
+		if inode==0: return self
+		root = base64.b32decode(tth+"=")
+		self._lock.acquire()
+		try:
+			if self._index.get((device,inode))==(size,mtime,root): return self
+			handle = open(self._path,"ab")
+			handle.write(self.record.pack(device,inode,size,mtime,root))
+			handle.close()
+			self._index[(device,inode)] = (size,mtime,root)
+			self._records += 1
+		finally: self._lock.release()
+		return self
+
+	def __contains__(self,key): # Whether a root has been recorded for the given (device, inode), regardless of whether it is still valid
+		return key in self._index
+
+	def __len__(self):
+		return len(self._index)
+
+def mtime(stat): # Returns the modification time of a stat result in integral nanoseconds.
+	# Always derived from the floating point st_mtime and rounded to microseconds, so that the result is the same whether or not the source provides st_mtime_ns (eg: os.stat on Python 2 versus the scandir module).
+	return int(round(stat.st_mtime*1000000))*1000